@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from loguru import logger
+from environment import blackjack
+from environment.batch_blackjack import BatchBlackjack
+from environment.gym_env import BlackjackEnv, BlackjackVectorEnv, GYMNASIUM
+from environment.core import Action, GameStatus
+from model.abstract_model import TestModel, transitions
+from model.MonteCarloControl import MonteCarloControl
+from model.SARSA import SARSA
+from model.QLearning import QLearning
+
+
+@pytest.fixture
+def table(request):
+    return blackjack.Table(*request.param)
+
+
+@pytest.mark.parametrize("table", [(0, 2), (1, 6), (3, 4)], indirect=True, ids=str)
+def test_equivalent_to_blackjack(table):
+    logger.disable("environment.blackjack")
+    np.random.seed(0)
+    game = blackjack.Blackjack(table=table)
+    rewards, decisions = [], []
+    for i in range(4000):
+        _, reward, player_trajectory = game.play(TestModel())
+        rewards.append(reward.mean())
+        decisions.append(np.mean([len(t) for t in player_trajectory]))
+
+    batch = BatchBlackjack(table, batch_size=20000)
+    status, batch_rewards, (observations, actions, lengths) = batch.play_batch(TestModel())
+    assert batch_rewards.shape == (20000, table.n - 1)
+    assert abs(np.mean(rewards) - batch_rewards.mean()) < 0.06
+    assert abs(np.mean(decisions) - lengths.mean()) < 0.06
+    # TestModel sticks on any sum of 20 or greater
+    played = np.arange(batch.max_decisions) < lengths[..., None]
+    assert np.all((observations[..., 0] >= 20) == (actions == 1), where=played)
+
+
+def test_shoe_runs_out():
+    # With the cut card at the end, the shoes run out in the middle of rounds, the cards in hand must not be dealt again
+    batch = BatchBlackjack(blackjack.Table(1, 6, penetration=1), batch_size=256)
+    for i in range(20):
+        batch.play_batch(TestModel(), record=False)
+        assert np.all(batch.counts >= 0)
+        assert np.all(batch.counts + batch.in_play <= batch.full_shoe)
+
+
+def test_play_drop_in():
+    logger.disable("environment.blackjack")
+    game = BatchBlackjack(blackjack.Table(0, 2), batch_size=64)
+    model = MonteCarloControl(game)
+    model.train(episodes=200, stop_at_convergence=False)
+    status, reward, player_trajectory = game.play(model)
+    assert reward.shape == (1, 1)
+    assert all(12 <= obs[0] <= 21 for obs, action in player_trajectory[0])
+
+
+@pytest.mark.parametrize("table", [(0, 3)], indirect=True, ids=str)
+def test_stream(table):
+    logger.disable("environment.blackjack")
+    for game in (blackjack.Blackjack(table=table), BatchBlackjack(table, batch_size=300)):
+        chunks = list(game.stream(TestModel(), episodes=1000, chunk_size=500))
+        records = np.concatenate(chunks)
+        assert all(len(chunk) == 500 for chunk in chunks[:-1])
+        assert records["episode"].min() == 0 and records["episode"].max() == 999
+        assert np.all(np.diff(records["episode"]) >= 0)
+        assert set(records["player"]) == {0, 1}
+        assert np.all((records["player_sum"] >= 20) == (records["action"] == 1))
+
+
+@pytest.mark.parametrize("model", [MonteCarloControl, SARSA, QLearning])
+def test_update_batch(model):
+    np.random.seed(0)
+    game = BatchBlackjack(blackjack.Table(0, 2), batch_size=1)
+    sequential, batched = model(game), model(game)
+    for i in range(200):
+        _, rewards, (observations, actions, lengths) = game.play_batch(sequential)
+        trajectory = [[(tuple(o), a) for o, a in zip(observations[0, 0, :lengths[0, 0]].tolist(),
+                                                      actions[0, 0, :lengths[0, 0]].tolist())]]
+        # A single gambler never repeats a state within an episode, so both updates are the same
+        updates = sequential.learn(rewards[0], trajectory, 0.1)
+        assert np.allclose(batched.update_batch(*transitions(rewards, observations, actions, lengths), 0.1), updates)
+        assert np.allclose(batched.Q, sequential.Q)
+
+    # A pair repeated k times in a batch moves as k sequential updates towards the same target
+    model = model(game)
+    states, actions = np.array([5] * 30 + [7]), np.array([1] * 30 + [0])
+    model.update_batch(states, actions, np.ones(31), -np.ones(31, dtype=int), -np.ones(31, dtype=int), 0.1)
+    assert model.Q.reshape(-1, 2)[5, 1] == pytest.approx(1 - 0.9 ** 30)
+    assert model.Q.reshape(-1, 2)[7, 0] == pytest.approx(0.1)
+
+
+@pytest.mark.parametrize("table", [(0, 2), (1, 4)], indirect=True, ids=str)
+def test_vector_env(table):
+    env = BlackjackVectorEnv(table, num_envs=2000)
+    observations, info = env.reset(seed=0)
+    assert observations.shape == (2000, 3) and observations.dtype == np.int64
+    rewards, steps = [], np.zeros(2000, dtype=int)
+    while len(rewards) < 10000:
+        assert np.all(observations[:, 0] >= 12, where=env.round_status == GameStatus.END)  # low sums are hit before asking
+        # TestModel's policy, which the other gamblers follow
+        observations, reward, terminated, truncated, info = env.step(
+            np.where(observations[:, 0] >= 20, Action.STICK, Action.HIT))
+        steps += 1
+        assert not truncated.any()
+        assert np.all(reward == 0, where=~terminated)
+        if terminated.any():
+            assert np.array_equal(info["_final_observation"], terminated)
+            rewards.extend(reward[terminated])
+            assert steps[terminated].max() <= BatchBlackjack.max_decisions
+            steps[terminated] = 0
+
+    _, batch_rewards, _ = BatchBlackjack(table, batch_size=20000).play_batch(TestModel(), record=False)
+    assert abs(np.mean(rewards) - batch_rewards[:, 0].mean()) < 0.05
+
+
+def test_env():
+    env = BlackjackEnv(blackjack.Table(0, 2))
+    episodes = []
+    for seed in (1, 1):
+        observation, info = env.reset(seed=seed)
+        episode, terminated = [tuple(observation)], False
+        while not terminated:
+            observation, reward, terminated, truncated, info = env.step(
+                Action.STICK if observation[0] >= 17 else Action.HIT)
+            episode.append((tuple(observation), reward))
+        assert reward in (-1, 0, 1, 1.5) and "status" in info
+        episodes.append(episode)
+    assert episodes[0] == episodes[1]  # same seed, same cards
+    if GYMNASIUM:
+        from gymnasium.utils.env_checker import check_env
+        check_env(env, skip_render_check=True)
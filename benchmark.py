@@ -0,0 +1,196 @@
+"""
+Throughput benchmarks of the environment and the learners.
+
+    python benchmark.py -o bench.json                     # run all benchmarks and write the results
+    python benchmark.py -k play                           # only the benchmarks whose name contains "play"
+    python benchmark.py --compare base.json bench.json    # compare two runs, fails on regressions
+
+Every benchmark reports a throughput (higher is better) and the peak memory allocated while it runs.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from itertools import product
+
+import numpy as np
+from loguru import logger
+
+from environment import blackjack
+from environment.batch_blackjack import BatchBlackjack
+from environment.core import Decks
+from environment.numba_engine import CompiledBlackjack
+from model.abstract_model import TestModel, transitions
+from model.MonteCarloControl import MonteCarloControl
+from model.SARSA import SARSA
+from model.QLearning import QLearning
+
+# Same (m, n) grid as learn_optimal_policy.py
+grid = [(0, 2)] + list(product([6, 3, 1], [3, 4, 6]))
+models = {
+    "MC": MonteCarloControl,
+    "TD": SARSA,
+    "QL": QLearning
+}
+
+
+def measure(f, repeat):
+    """
+    Run f() repeat times, and once more tracing memory allocations (which slows it down).
+    :return: best throughput of the runs (f returns the number of items it processed) and peak memory in bytes.
+    """
+    best = 0
+    for i in range(repeat):
+        start = time.perf_counter()
+        items = f()
+        best = max(best, items / (time.perf_counter() - start))
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def benchmarks(scale):
+    """
+    Yield (name, unit, setup) of every benchmark, scale multiplies the amount of work. setup() builds the games,
+    models and episodes of the benchmark, only for the ones run, and returns the function measured.
+    """
+    for m, n in grid:
+        def setup(m=m, n=n):
+            def play(game=blackjack.Blackjack(blackjack.Table(m, n), trace=False), episodes=int(2000 * scale)):
+                for i in range(episodes):
+                    game.play(TestModel())
+                return episodes
+            return play
+        yield "play_m{}_n{}".format(m, n), "episodes/s", setup
+
+    def setup():
+        def play_sampled(game=blackjack.Blackjack(blackjack.Table(0, 2), trace=False, sample_dealer=True),
+                         episodes=int(2000 * scale)):
+            for i in range(episodes):
+                game.play(TestModel())
+            return episodes
+        return play_sampled
+    yield "play_sampled_m0_n2", "episodes/s", setup
+
+    for m, n in [(0, 2), (6, 6)]:
+        # A tabular model on both engines, the compiled one is the fastest with Numba (without it, it plays Blackjack)
+        for name, Game in [("play_tabular", blackjack.Blackjack), ("play_compiled", CompiledBlackjack)]:
+            def setup(m=m, n=n, Game=Game):
+                game = Game(blackjack.Table(m, n))
+                game.trace = False
+
+                def play_tabular(episodes=int(2000 * scale)):
+                    model = MonteCarloControl(game)
+                    for i in range(episodes):
+                        game.play(model)
+                    return episodes
+                game.play(MonteCarloControl(game))  # compile beforehand
+                return play_tabular
+            yield "{}_m{}_n{}".format(name, m, n), "episodes/s", setup
+
+    for m, n in [(0, 2), (6, 6)]:
+        def setup(m=m, n=n):
+            def play_batch(game=BatchBlackjack(blackjack.Table(m, n), batch_size=int(20000 * scale)),
+                           model=MonteCarloControl(None)):
+                game.play_batch(model)
+                return game.batch_size
+            return play_batch
+        yield "play_batch_m{}_n{}".format(m, n), "episodes/s", setup
+
+    for name, model in models.items():
+        def setup(model=model):
+            game = blackjack.Blackjack(blackjack.Table(0, 2), trace=False)
+            episodes = [game.play(TestModel())[1:] for i in range(int(2000 * scale))]
+
+            def learn(model=model(game), episodes=episodes):
+                return sum(len(model.learn(rewards, player_trajectory, 0.01))
+                           for rewards, player_trajectory in episodes)
+            return learn
+        yield "learn_{}".format(name), "updates/s", setup
+
+        def setup(model=model):
+            _, rewards, trajectories = BatchBlackjack(blackjack.Table(0, 2), batch_size=int(2000 * scale)).play_batch(
+                TestModel())
+            batch = transitions(rewards, *trajectories)
+
+            def learn_batch(model=model(None), batch=batch):
+                return len(model.update_batch(*batch, 0.01))
+            return learn_batch
+        yield "learn_batch_{}".format(name), "updates/s", setup
+
+    for m, penetration in [(0, None), (6, None), (6, 0.75)]:
+        def setup(m=m, penetration=penetration):
+            def deal(decks=Decks(m, penetration), cards=int(20000 * scale)):
+                for i in range(cards // 10):  # about the cards of one episode
+                    decks.next_round()
+                    decks.deal(10)
+                return cards
+            return deal
+        yield "deal_m{}_{}".format(m, "shoe" if penetration else "fresh"), "cards/s", setup
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    logger.disable("environment.blackjack")
+    np.random.seed(args.seed)
+    results = {}
+    for name, unit, setup in benchmarks(args.scale):
+        if args.k and args.k not in name:
+            continue
+        throughput, peak = measure(setup(), args.repeat)
+        results[name] = {"throughput": throughput, "unit": unit, "peak_memory": peak}
+        print("{:24s} {:14.1f} {:12s} peak memory {:8.1f} KiB".format(name, throughput, unit, peak / 1024))
+
+    record = {"commit": git_commit(), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python": platform.python_version(), "numpy": np.__version__, "scale": args.scale,
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(record, f, indent=2)
+    print("Results of commit {} written to {}".format(record["commit"], args.output))
+
+
+def compare(args):
+    with open(args.compare[0]) as f:
+        base = json.load(f)
+    with open(args.compare[1]) as f:
+        new = json.load(f)
+    regressions = []
+    print("{:24s} {:>14s} {:>14s} {:>8s}".format("benchmark", base["commit"], new["commit"], "ratio"))
+    for name in base["results"]:
+        if name not in new["results"]:
+            continue
+        before, after = base["results"][name]["throughput"], new["results"][name]["throughput"]
+        ratio = after / before
+        flag = ""
+        if ratio < 1 - args.threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        print("{:24s} {:14.1f} {:14.1f} {:8.2f} {}".format(name, before, after, ratio, flag))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput benchmarks of the environment and the learners.")
+    parser.add_argument("-o", "--output", default="bench.json", help="file the results are written to")
+    parser.add_argument("-k", default=None, help="only run benchmarks whose name contains this string")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier of the amount of work")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every benchmark, the best one is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative throughput drop reported as a regression")
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(compare(args))
+    run(args)
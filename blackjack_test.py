@@ -1,9 +1,18 @@
+import shutil
+import time
 from itertools import product
+import numpy as np
 import pytest
 
 from loguru import logger
-from environment import blackjack
+from environment import blackjack, numba_engine
+from environment.batch_blackjack import BatchBlackjack
+from environment.core import Decks, GameStatus, PlayerStatus, settle, settle_table
+from environment.dealer import DealerOutcomes, dealer_distribution, dealer_outcome, shoe_outcome
+from environment.numba_engine import CompiledBlackjack, NUMBA
+from environment.util import ExperienceRecorder, ExperienceReplay
 from model.abstract_model import TestModel
+from model.MonteCarloControl import MonteCarloControl
 
 logger.add("test.log", enqueue=True)
 
@@ -34,3 +43,174 @@ def test_two(game, model):
 def test_combinations(game, model):
     print([game.table.m, game.table.n])
     game.play(models[model])
+
+
+@pytest.mark.parametrize("game", [(1, 3)], indirect=["game"], ids=str)
+def test_recorder(game, tmp_path):
+    logger.disable("environment.blackjack")
+    recorder = ExperienceRecorder(str(tmp_path), chunk_size=100)
+    game.recorder = recorder
+    episodes = [game.play(models["Test"])[1:] for i in range(300)]
+    recorder.flush()
+    assert len(recorder.chunks()) > 1
+
+    replayed = list(ExperienceRecorder(str(tmp_path)).replay())
+    assert len(replayed) == 300
+    for (reward, player_trajectory), (replayed_reward, replayed_trajectory) in zip(episodes, replayed):
+        assert np.array_equal(reward, replayed_reward)
+        assert player_trajectory == replayed_trajectory
+
+    replay = ExperienceReplay(recorder)
+    for i in range(301):
+        status, reward, player_trajectory = replay.play(models["Test"])
+    assert player_trajectory == episodes[0][1]
+
+    recorder = ExperienceRecorder()  # in a temporary directory
+    recorder.watch(*episodes[0])
+    recorder.flush()
+    assert len(list(recorder.replay())) == 1
+    shutil.rmtree(recorder.directory)
+
+
+def test_trace():
+    logger.enable("environment.blackjack")
+    messages = []
+    sink = logger.add(messages.append, format="{message}")
+    game = blackjack.Blackjack(blackjack.Table(0, 2), trace={1, 3})
+    for i in range(5):
+        game.play(models["Test"])
+    assert sum(message.startswith("Game starts") for message in messages) == 2
+    # Every episode is traced by default, but only while the logger emits the messages
+    game = blackjack.Blackjack(blackjack.Table(0, 2))
+    game.play(models["Test"])
+    assert game.tracing
+    logger.disable("environment.blackjack")
+    game.play(models["Test"])
+    assert not game.tracing
+    logger.remove(sink)
+
+
+@pytest.mark.parametrize("table", [(0, 2), (3, 4), (1, 6, 0.75), (1, 6, 1)], ids=str)
+@pytest.mark.parametrize("exploration_rate", [0, 0.3], ids=str)
+def test_compiled_blackjack(table, exploration_rate):
+    # Compiled or not, the engine draws the numbers of the same random buffers: the episodes are exactly the same
+    play = {blackjack.Blackjack: blackjack.Blackjack.play, CompiledBlackjack: CompiledBlackjack.play_compiled}
+    logger.disable("environment.blackjack")
+    model = MonteCarloControl(blackjack.Blackjack(blackjack.Table(0, 2)), exploration_rate=exploration_rate)
+    model.Q = np.round(np.random.RandomState(0).random(model.Q.shape), 1)  # with ties
+    episodes = []
+    for Game in (blackjack.Blackjack, CompiledBlackjack):
+        model.rng = np.random.default_rng(1)
+        game = Game(blackjack.Table(*table, rng=0))
+        game.trace = False
+        episodes.append([play[Game](game, model) for i in range(2000)])
+
+    for (status, reward, player_trajectory), expected in zip(episodes[1], episodes[0]):
+        assert status == expected[0]
+        assert np.array_equal(reward, expected[1])
+        assert player_trajectory == expected[2]
+
+
+@pytest.mark.skipif(not NUMBA, reason="Numba is not installed")
+def test_compiled_faster():
+    logger.disable("environment.blackjack")
+    times = []
+    for Game in (blackjack.Blackjack, CompiledBlackjack):
+        game = Game(blackjack.Table(6, 6, rng=0))
+        model = MonteCarloControl(game, rng=1)
+        game.play(model)  # compile
+        start = time.perf_counter()
+        for i in range(2000):
+            game.play(model)
+        times.append(time.perf_counter() - start)
+    assert times[1] < times[0] / 2
+
+
+def legacy_settlement(game_status, points, status):
+    # The rules of the settlement table by table, as Blackjack.__settlement applied them before core.settle
+    gamblers = [0 if p > 21 else p for p in points[:-1]]
+    dealer = 0 if points[-1] > 21 else points[-1]
+    if game_status == GameStatus.DRAW:
+        return [0] * len(gamblers)
+    if game_status == GameStatus.NATURAL:
+        return [1.5 if s == PlayerStatus.NATURAL else -1 for s in status[:-1]]
+    if status[-1] == PlayerStatus.LOSE_BUST:
+        if PlayerStatus.STICK in list(status[:-1]):
+            return [1 if p != 0 else -1 for p in gamblers]
+        return [0] * len(gamblers)
+    if max(gamblers) < dealer:
+        return [-1] * len(gamblers)
+    if max(gamblers) == dealer:
+        return [0] * len(gamblers)
+    return [1 if p >= dealer else -1 for p in gamblers]
+
+
+@pytest.mark.parametrize("n", [2, 3, 6], ids=str)
+def test_settle(n):
+    logger.disable("environment.blackjack")
+    rng = np.random.default_rng(n)
+    size = 5000
+    game_status = rng.choice([GameStatus.END, GameStatus.NATURAL, GameStatus.DRAW], size=size, p=[0.8, 0.1, 0.1])
+    # Consistent final hands: gamblers stick from 12 or go bust, the dealer sticks from 17 or goes bust
+    bust = rng.random((size, n)) < 0.3
+    points = np.where(bust, rng.integers(22, 31, (size, n)), rng.integers(12, 22, (size, n)))
+    points[:, -1] = np.where(bust[:, -1], points[:, -1], rng.integers(17, 22, size))
+    status = np.where(bust, PlayerStatus.LOSE_BUST, PlayerStatus.STICK)
+    dealt = game_status != GameStatus.END
+    natural = rng.random((size, n)) < 0.3
+    points[dealt] = np.where(natural[dealt], 21, rng.integers(4, 21, (np.count_nonzero(dealt), n)))
+    status[dealt] = np.where(natural[dealt], PlayerStatus.NATURAL, PlayerStatus.PLAYING)
+    expected = np.array([legacy_settlement(*args) for args in zip(game_status, points, status)], dtype=float)
+    assert len(np.unique(expected)) == 4
+
+    assert np.array_equal(settle(game_status, points, status), expected)
+    batch = BatchBlackjack(blackjack.Table(0, n), batch_size=size)
+    batch.raw, batch.usable, batch.status = points, np.zeros_like(points), status
+    assert np.array_equal(batch.settlement(game_status), expected)
+
+    game = blackjack.Blackjack(blackjack.Table(0, n), trace=False)
+    hands = np.zeros((n, 5), dtype=np.int64)
+    rewards = np.zeros(n - 1)
+    for i in range(0, size, 10):
+        assert np.array_equal(settle(game_status[i], points[i], status[i]), expected[i])
+        assert settle_table(game_status[i], points[i].tolist(), status[i].tolist()) == expected[i].tolist()
+        for player, p, s in zip(game.table.players, points[i], status[i]):
+            player.state.points, player.status = p, PlayerStatus(s)
+        assert np.array_equal(game._Blackjack__settlement(GameStatus(game_status[i])), expected[i, :, None])
+        hands[:, numba_engine.PLAYER_POINTS] = points[i]
+        numba_engine.settle(game_status[i], hands, status[i], rewards)
+        assert np.array_equal(rewards, expected[i])
+
+
+def test_dealer_outcomes():
+    logger.disable("environment.blackjack")
+    outcomes = DealerOutcomes(Decks(0))
+    for show in range(1, 11):
+        # Naturals are never detected, the dealer plays every hole card
+        assert np.allclose(outcomes.by_up_card(show), dealer_distribution(show))
+    # Exact with finite decks by default, coarser resolutions round the shoe
+    decks = Decks(2)
+    decks.deal(7)
+    exact = shoe_outcome((12, False, False), DealerOutcomes(decks).counts(), {})
+    assert DealerOutcomes(decks).lookup((12, False, False)) == exact
+    assert DealerOutcomes(decks, resolution=2).lookup((12, False, False)) != exact
+    # A huge shoe is all but an infinite deck
+    counts = tuple([400] * 9 + [1600])
+    assert np.allclose(shoe_outcome((12, False, False), counts, {}), dealer_outcome((12, False, False)), atol=1e-3)
+
+    rewards = []
+    for sample_dealer in (False, True):
+        game = blackjack.Blackjack(blackjack.Table(0, 3, rng=0), trace=False, sample_dealer=sample_dealer)
+        rewards.append(np.mean([game.play(models["Test"])[1].mean() for i in range(20000)]))
+    assert rewards[0] == pytest.approx(rewards[1], abs=0.03)
+
+    decks = Decks(1)
+    outcomes = DealerOutcomes(decks, maxsize=1000)
+    for i in range(1000):
+        decks.next_round()
+        decks.deal(4)
+        outcomes.lookup((12, False, False))
+    assert len(outcomes.cache) <= 1000 and outcomes.hits > 0
+    for table in (blackjack.Table(1, 3), blackjack.Table(6, 3, 0.75)):
+        with pytest.raises(AssertionError):
+            blackjack.Blackjack(table, sample_dealer=True)
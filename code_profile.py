@@ -6,7 +6,7 @@ if __name__ == '__main__':
     logger.disable("environment.blackjack")
     episodes = 1000
     table = blackjack.Table(m=0, n=2)
-    game = blackjack.Blackjack(table=table)
+    game = blackjack.Blackjack(table=table, trace=False)
     policy = MonteCarloControl(game)
     policy.train(episodes, exploration_decay=1-1e-5)
 
@@ -0,0 +1,311 @@
+import json
+import numpy as np
+from environment.core import *
+from environment.blackjack import Table
+from model.abstract_model import AbstractModel
+from model.dealer_policy import DealerPolicy
+
+
+class BatchBlackjack(object):
+    """Blackjack engine playing `batch_size` independent tables at once.
+    Hands are kept as NumPy arrays of shape (tables, players) instead of Card objects:
+        raw:     sum of the cards in hand, aces counted as 1 and face cards as 10
+        usable:  whether the player currently holds a usable ace
+        has_ace: whether there is an ace in hand
+        ncards:  number of cards in hand
+        status:  PlayerStatus of every player
+    The rules are exactly those of Blackjack.play (including the way Player.draw updates the usable ace),
+    so rewards and trajectories are statistically equivalent to playing the tables one by one.
+    """
+    actions = [Action.HIT, Action.STICK]
+    reward_win = 1
+    reward_lose = -1
+    reward_draw = 0
+    reward_natural = 1.5
+    # A decision is only made with 12 <= points, and every hit increases the raw sum of the hand by at least 1,
+    # so a gambler can not make more than 20 decisions (plus the one recorded when the game ends at dealing).
+    max_decisions = 21
+
+    def __init__(self, table: Table, batch_size=1024, rng=None):
+        """
+        :param table: Table providing the deck of cards (m) and the number of players (n).
+        :type table: Table
+        :param batch_size: number of tables played in parallel.
+        :type batch_size: int
+        :param rng: random generator dealing the cards, or its seed, by default the one of the table.
+        :type rng: numpy.random.Generator
+        """
+        assert batch_size >= 1, "There must be at least 1 table!"
+        self.table = table
+        self.m = table.m
+        self.n = table.n
+        self.penetration = table.decks.penetration
+        if self.m > 0:
+            self.full_shoe = np.array([4] * 9 + [16]) * self.m  # number of cards of every value in a full shoe
+            self.counts = np.tile(self.full_shoe, (batch_size, 1))
+            self.in_play = np.zeros_like(self.counts)  # number of cards of every value dealt in the current round
+        self.batch_size = batch_size
+        self.rng = table.rng if rng is None else default_rng(rng)
+        self.__buffer = None
+        self.__cursor = 0
+
+    def checkpoint(self) -> dict:
+        """
+        State of the generator and of the shoes between two batches, see TabularModel.save_checkpoint.
+        """
+        state = {"rng": json.dumps(self.rng.bit_generator.state)}
+        if self.m > 0:
+            state["counts"] = self.counts.copy()
+        return state
+
+    def restore(self, state: dict):
+        self.rng.bit_generator.state = json.loads(str(state["rng"]))
+        if self.m > 0:
+            self.counts[:] = state["counts"]
+
+    def reset(self, rows=None):
+        """
+        Reset the given tables (all of them by default) and deal two cards to every player.
+        :param rows: indices of the tables
+        :type rows: numpy.array
+        """
+        shape = (self.batch_size, self.n)
+        if rows is None:
+            rows = np.arange(self.batch_size)
+            self.raw = np.zeros(shape, dtype=np.int64)
+            self.usable = np.zeros(shape, dtype=bool)
+            self.has_ace = np.zeros(shape, dtype=bool)
+            self.ncards = np.zeros(shape, dtype=np.int64)
+            self.status = np.full(shape, PlayerStatus.PLAYING, dtype=np.int64)
+            self.dealer_face_up = np.zeros(self.batch_size, dtype=np.int64)
+        else:
+            self.raw[rows] = 0
+            self.usable[rows] = False
+            self.has_ace[rows] = False
+            self.ncards[rows] = 0
+            self.status[rows] = PlayerStatus.PLAYING
+        if self.m > 0:
+            # Remaining cards in every shoe, indexed by card value - 1 (face cards are counted as 10).
+            # With a penetration, a shoe is only refilled once its cut card has been reached.
+            if self.penetration is None:
+                self.counts[rows] = self.full_shoe
+            else:
+                dealt = self.full_shoe.sum() - self.counts[rows].sum(axis=1)
+                self.counts[rows[dealt >= int(self.penetration * self.full_shoe.sum())]] = self.full_shoe
+            self.in_play[rows] = 0
+
+        for j in range(self.n):
+            first = self.deal(rows)
+            if j == self.n - 1:
+                self.dealer_face_up[rows] = first
+            self.draw(rows, j, [first, self.deal(rows)])
+
+    @property
+    def points(self):
+        return self.raw + 10 * self.usable
+
+    def points_of(self, rows, j):
+        return self.raw[rows, j] + 10 * self.usable[rows, j]
+
+    def deal(self, rows):
+        """
+        Deal one card to each of the given tables.
+        :param rows: indices of the tables
+        :type rows: numpy.array
+        :return: values of the cards dealt, face cards are counted as 10.
+        :rtype: numpy.array
+        """
+        if self.m == 0:
+            return np.minimum(self.rng.integers(1, 14, size=len(rows)), 10)
+        # Without replacement: pick the k-th remaining card of every shoe
+        empty = rows[self.counts[rows].sum(axis=1) == 0]
+        # The shoe runs out in the middle of an episode: start a new one with the discards, the cards in hand stay out.
+        self.counts[empty] = self.full_shoe - self.in_play[empty]
+        cumsum = self.counts[rows].cumsum(axis=1)
+        k = (self.rng.random(len(rows)) * cumsum[:, -1]).astype(np.int64)
+        idx = (cumsum > k[:, None]).argmax(axis=1)
+        self.counts[rows, idx] -= 1
+        self.in_play[rows, idx] += 1
+        return idx + 1
+
+    def draw(self, rows, j, cards):
+        """
+        Vectorized Player.draw: add the cards to the hand of player j on the given tables.
+        :param rows: indices of the tables
+        :type rows: numpy.array
+        :param j: index of the player
+        :type j: int
+        :param cards: list of arrays of card values, all drawn at once.
+        :type cards: List[numpy.array]
+        """
+        raw = self.raw[rows, j] + sum(cards)
+        has_ace = self.has_ace[rows, j] | np.any([c == 1 for c in cards], axis=0)
+        # Player.draw turns the first ace usable only if it was not usable before the draw
+        usable = has_ace & (raw <= 11) & ~self.usable[rows, j]
+        ncards = self.ncards[rows, j] + len(cards)
+
+        status = self.status[rows, j]
+        status[raw > 21] = PlayerStatus.LOSE_BUST
+        status[(raw + 10 * usable + 10 == 21) & (ncards == 2) & usable] = PlayerStatus.NATURAL
+
+        self.raw[rows, j] = raw
+        self.has_ace[rows, j] = has_ace
+        self.usable[rows, j] = usable
+        self.ncards[rows, j] = ncards
+        self.status[rows, j] = status
+
+    def observe(self, rows, j):
+        """
+        Observations (PlayerSum, DealerShow, UsableAce) of player j on the given tables.
+        :rtype: numpy.array of shape (len(rows), 3)
+        """
+        return np.stack([self.points_of(rows, j),
+                         self.dealer_face_up[rows],
+                         self.usable[rows, j]], axis=1)
+
+    def game_status(self):
+        """
+        Vectorized Blackjack.__status after dealing.
+        """
+        gambler_natural = (self.status[:, :-1] == PlayerStatus.NATURAL).any(axis=1)
+        dealer_natural = self.status[:, -1] == PlayerStatus.NATURAL
+        status = np.full(self.batch_size, GameStatus.END, dtype=np.int64)
+        status[gambler_natural | dealer_natural] = GameStatus.NATURAL
+        status[gambler_natural & dealer_natural] = GameStatus.DRAW
+        return status
+
+    def predict(self, model: AbstractModel, obs):
+        """
+        Actions of the model for a batch of observations, see AbstractModel.predict_batch. Models without their own
+        random generator draw from the one of the game.
+        """
+        return model.predict_batch(obs, getattr(model, "rng", self.rng))
+
+    def settlement(self, status):
+        """
+        Rewards of all the tables at once, see core.settle.
+        :param status: Ending status of every table
+        :type status: numpy.array
+        :return: rewards to each gambler on each table
+        :rtype: numpy.array of shape (batch_size, n-1)
+        """
+        return settle(status, self.points, self.status, self.reward_win, self.reward_lose, self.reward_draw,
+                      self.reward_natural)
+
+    def play_turn(self, model: AbstractModel, rows, j, trajectories=None):
+        """
+        Let player j play on the given tables until it sticks or goes bust, with the model for a gambler and the
+        DealerPolicy for the dealer (last player).
+        :param rows: indices of the tables
+        :type rows: numpy.array
+        :param trajectories: (observations, actions, lengths) arrays recording the decisions of the gamblers, as
+            returned by play_batch, optional.
+        :type trajectories: (numpy.array, numpy.array, numpy.array)
+        """
+        rows = rows[self.status[rows, j] == PlayerStatus.PLAYING]
+        while rows.size:
+            low = rows[self.points_of(rows, j) < 12]
+            while low.size:  # if sum of player is less than 12, always hit
+                self.draw(low, j, [self.deal(low)])
+                low = low[self.points_of(low, j) < 12]
+
+            obs = self.observe(rows, j)
+            if j == self.n - 1:
+                action = DealerPolicy.predict_batch(obs)
+            else:
+                action = self.predict(model, obs)
+                if trajectories is not None:
+                    observations, actions, lengths = trajectories
+                    observations[rows, j, lengths[rows, j]] = obs
+                    actions[rows, j, lengths[rows, j]] = action
+                    lengths[rows, j] += 1
+
+            hit = rows[action == Action.HIT]
+            self.draw(hit, j, [self.deal(hit)])
+            self.status[rows[action == Action.STICK], j] = PlayerStatus.STICK
+            rows = rows[self.status[rows, j] == PlayerStatus.PLAYING]
+
+    def play_batch(self, model: AbstractModel, record=True):
+        """
+        Play one round of the Blackjack game on every table.
+        :param model: The model for gambler's action.
+        :type model: AbstractModel
+        :param record: whether to record the trajectories, evaluating a policy only needs the rewards.
+        :type record: bool
+        :return: Game ending status, rewards and trajectories (observations, actions, lengths) of every table.
+            observations has shape (batch_size, n-1, max_decisions, 3), actions (batch_size, n-1, max_decisions),
+            and lengths (batch_size, n-1) gives the number of decisions each gambler made. Trajectories are None
+            when not recorded.
+        :rtype: numpy.array, numpy.array, (numpy.array, numpy.array, numpy.array)
+        """
+        self.reset()
+        status = self.game_status()
+        over = status != GameStatus.END
+
+        if record:
+            observations = np.zeros((self.batch_size, self.n - 1, self.max_decisions, 3), dtype=np.int64)
+            actions = np.zeros((self.batch_size, self.n - 1, self.max_decisions), dtype=np.int64)
+            lengths = np.zeros((self.batch_size, self.n - 1), dtype=np.int64)
+
+            # Games finished right after dealing still record one decision of every gambler
+            rows = np.flatnonzero(over)
+            if rows.size:
+                for j in range(self.n - 1):
+                    obs = self.observe(rows, j)
+                    observations[rows, j, 0] = obs
+                    actions[rows, j, 0] = self.predict(model, obs)
+                    lengths[rows, j] = 1
+
+        for j in range(self.n):
+            self.play_turn(model, np.flatnonzero(~over), j, (observations, actions, lengths) if record else None)
+
+        return status, self.settlement(status), (observations, actions, lengths) if record else None
+
+    def play(self, model: AbstractModel):
+        """
+        Drop-in replacement of Blackjack.play, episodes are served from the last played batch.
+        Note that the whole batch is played with the policy of the model at the time the batch starts.
+        :return: Game ending status, rewards, player_trajectorys
+        :rtype: GameStatus, numpy.array, List[List[(player_sum, dealer_showing, usable_ace)]]
+        """
+        if self.__buffer is None or self.__cursor >= self.batch_size:
+            self.__buffer = self.play_batch(model)
+            self.__cursor = 0
+        i = self.__cursor
+        self.__cursor += 1
+
+        status, rewards, (observations, actions, lengths) = self.__buffer
+        player_trajectory = [list(zip(map(tuple, observations[i, j, :lengths[i, j]].tolist()),
+                                      actions[i, j, :lengths[i, j]].tolist()))
+                             for j in range(self.n - 1)]
+        return GameStatus(status[i]), rewards[i].reshape((self.n - 1, 1)), player_trajectory
+
+    def stream(self, model: AbstractModel, episodes, chunk_size=65536):
+        """
+        Same as Blackjack.stream, with the episodes played batch by batch.
+        """
+        chunk = np.empty(chunk_size, dtype=EXPERIENCE_DTYPE)
+        k = 0
+        for start in range(0, episodes, self.batch_size):
+            _, rewards, (observations, actions, lengths) = self.play_batch(model)
+            played = np.arange(self.max_decisions) < lengths[:episodes - start, :, None]
+            table, player, t = np.nonzero(played)
+            records = np.empty(len(table), dtype=EXPERIENCE_DTYPE)
+            records["episode"] = start + table
+            records["player"] = player
+            for i, field in enumerate(("player_sum", "dealer_show", "usable_ace")):
+                records[field] = observations[table, player, t, i]
+            records["action"] = actions[table, player, t]
+            records["reward"] = rewards[table, player]
+
+            while len(records):
+                size = min(chunk_size - k, len(records))
+                chunk[k:k + size] = records[:size]
+                records = records[size:]
+                k += size
+                if k == chunk_size:
+                    yield chunk
+                    chunk = np.empty(chunk_size, dtype=EXPERIENCE_DTYPE)
+                    k = 0
+        if k:
+            yield chunk[:k]
@@ -1,22 +1,26 @@
 import numpy as np
 from loguru import logger
 from enum import IntEnum
-from collections import Counter
 from environment.core import *
 from model.abstract_model import  AbstractModel
 from model.dealer_policy import  DealerPolicy
+from environment.dealer import DealerOutcomes
 
 class Table(object):
     """A Poker table, with decks of cards and a few players.
     1. Two ways to initialize a Table instance, by provide the deck of cards and number of players,
        or directly provide a list of players.
     """
-    def __init__(self, m: int, n: int):
+    def __init__(self, m: int, n: int, penetration: float = None, rng=None):
         """
         :param m: deck of cards, 0 indicates infinity, negative value is invalid.
         :type m: int
         :param n: number of players, must be greater or equal to 2.
         :type n: int
+        :param penetration: fraction of the shoe dealt before reshuffling, None to use a new shoe every episode.
+        :type penetration: float
+        :param rng: random generator dealing the cards, or its seed, see core.default_rng.
+        :type rng: numpy.random.Generator
         """
         assert m >= 0, "Negative deck of cards is invalid!"
         self.m = m
@@ -27,7 +31,8 @@ class Table(object):
         for i in range(n-1):
             self.players.append(Gambler())
         self.players.append(Dealer())
-        self.decks = Decks(m)
+        self.decks = Decks(m, penetration, rng)
+        self.__points = np.zeros(n, dtype=int)
 
         self.reset()
 
@@ -56,13 +61,21 @@ class Table(object):
         self.reset()
     """
 
+    @property
+    def rng(self):
+        return self.decks.rng
+
+    @rng.setter
+    def rng(self, rng):
+        self.decks.rng = rng
+
     def reset(self):
         self.__reset_decks(self.m)
         self.__reset_players()
 
     def __reset_decks(self, m: int):
-        # Reset the decks on table by creating a new Decks object
-        self.decks.reset(m)
+        # Reset the decks on table, or keep dealing from the same shoe until the cut card
+        self.decks.next_round()
 
     def __reset_players(self):
         # Reset players' states after one eposide
@@ -83,9 +96,9 @@ class Table(object):
         Deal n cards to every player.
         """
         for player in self.players:
-            if player.state.hand:
-                raise Exception("Player {} already has {} cards in hand!".format(player.name, len(player.state.hand)))
-            player.draw(self.decks.dealCard(n))
+            if player.state.codes:
+                raise Exception("Player {} already has {} cards in hand!".format(player.name, len(player.state.codes)))
+            player.draw_codes(self.decks.deal(n))
 
     @property
     def players_status(self):
@@ -94,24 +107,84 @@ class Table(object):
         """
         return [player.status for player in self.players]
 
+    @property
+    def players_points(self):
+        """
+        All players' points, filled into the same array every time.
+        """
+        for i, player in enumerate(self.players):
+            self.__points[i] = player.state.points
+        return self.__points
+
 
 class Blackjack:
     actions = [Action.HIT, Action.STICK]
     reward_win = 1
     reward_lose = -1
     reward_draw = 0
-    
-    def __init__(self, table: Table) -> object:
+    reward_natural = 1.5
+
+    def __init__(self, table: Table, recorder=None, trace=True, sample_dealer=False) -> object:
+        """
+        :param table: the table to play on.
+        :type table: Table
+        :param recorder: an ExperienceRecorder watching every episode played, optional.
+        :type recorder: ExperienceRecorder
+        :param trace: which episodes to log, True for all, False for none, or a container of episode indices
+            (e.g. range(0, 10**6, 1000)), or a function of the episode index. An episode is only traced once loguru
+            emits its first message (lazily formatted), so with the logger of this module disabled (logger.disable)
+            or no handler taking INFO messages, the messages of the episode are not even formatted and logging
+            costs close to nothing, whatever the trace.
+        :type trace: Union[bool, Container[int], Callable[[int], bool]]
+        :param sample_dealer: whether the dealer's turn is replaced by one draw of his final points, from the exact
+            distribution given his hand (see dealer.py). Only with an infinite deck (m = 0): with finite decks the
+            distributions depend on the cards left, and looking them up costs more than playing the dealer's turn.
+        :type sample_dealer: bool
+        """
+        assert not (sample_dealer and table.decks.m != 0), \
+            "The dealer's turn can only be sampled with an infinite deck (m = 0)!"
         self.table = table
-        self.recorder = None
+        self.recorder = recorder
+        self.trace = trace
+        self.dealer_outcomes = DealerOutcomes(table.decks) if sample_dealer else None
+        self.episode = -1  # index of current episode
+        self.tracing = False  # whether current episode is logged
         # self.reset()
         self.player_reward = np.zeros(shape=(self.table.n - 1, 1))  # Does dealer need reward?
 
+    @property
+    def rng(self):
+        # The game draws random numbers only to deal cards
+        return self.table.rng
+
+    @rng.setter
+    def rng(self, rng):
+        self.table.rng = rng
+
+    def checkpoint(self) -> dict:
+        """
+        State of the game between two episodes, see TabularModel.save_checkpoint.
+        """
+        return {"episode": self.episode, "decks": self.table.decks.checkpoint()}
+
+    def restore(self, state: dict):
+        self.episode = int(state["episode"])
+        self.table.decks.restore(state["decks"])
+
+    @property
+    def dealer_face_up(self):
+        return self.table.players[-1].state.hand[0]
+
+    def __start_tracing(self):
+        self.tracing = True
+        return self.table.m if self.table.m > 0 else "infinite"
+
     def reset(self):
         self.table.reset()  # reset decks and players
         self.table.deal_all(n=2)
-        self.dealer_face_up = self.table.players[-1].state.hand[0]
-        logger.info("Every player has drawn two cards.\n{}\nDealer's facing up card is {}.".format([p.state.hand for p in self.table.players], self.dealer_face_up))
+        self.dealer_show = CARD_POINTS[self.table.players[-1].state.codes[0]]
+        if self.tracing:
+            logger.info("Every player has drawn two cards.\n{}\nDealer's facing up card is {}.".format([p.state.hand for p in self.table.players], self.dealer_face_up))
         self.act = 0  # index of current actor among players list
 
     def step(self, action):
@@ -119,10 +192,11 @@ class Blackjack:
         self.__execute(action)
         status = self.__status()
 
-        logger.debug("Player {}: action: {:6s}, status: {}. {}".format(self.act,
-                                                                    Action(action).name,
-                                                                    PlayerStatus(player.status).name,
-                                                                    player.state.hand))
+        if self.tracing:
+            logger.debug("Player {}: action: {:6s}, status: {}. {}".format(self.act,
+                                                                        Action(action).name,
+                                                                        PlayerStatus(player.status).name,
+                                                                        player.state.hand))
 
         if (action == Action.STICK or player.status == PlayerStatus.LOSE_BUST) \
                 and status == GameStatus.PLAYING:
@@ -139,7 +213,7 @@ class Blackjack:
             else:
                 raise Exception("Hey, player {} has gone busted, how can him continue to take action?".format(self.act))
         if action == Action.HIT:
-            player.draw(self.table.decks.dealCard(n=1))
+            player.draw_codes(self.table.decks.deal(n=1))
 
     def __possible_actions(self):
         player = self.table.players[self.act]
@@ -162,7 +236,8 @@ class Blackjack:
             else:  # else still natural
                 return GameStatus.NATURAL
         elif self.table.players_status[-1] == PlayerStatus.NATURAL:
-            logger.info("Dealer got natural!")
+            if self.tracing:
+                logger.info("Dealer got natural!")
             return GameStatus.NATURAL
 
         if self.table.players_status.count(PlayerStatus.PLAYING) == 0:
@@ -183,7 +258,7 @@ class Blackjack:
         # self.dealer_face_up = self.table.players[-1].state.hand[0]  # dealer's first card is face-up
         # player_cards = self.table.players[self.act].state.hand
         return (self.table.players[self.act].points,
-                min(self.dealer_face_up.value, 10),
+                self.dealer_show,
                 self.table.players[self.act].state.usable_ace.value)
 
     def __is_over(self, status=None):
@@ -200,95 +275,49 @@ class Blackjack:
             return True
         return False
 
+    def __sample_dealer(self, dealer):
+        """
+        The dealer's turn in one draw of his final points, the gamblers being done.
+        :return: Game status, the game ends.
+        :rtype: GameStatus
+        """
+        state = dealer.state
+        final = self.dealer_outcomes.sample((state.raw, state.usable_ace == UsableAce.USABLE, state.has_ace),
+                                            self.table.decks.random)
+        state.points = final  # 0 when he goes bust, as the settlement counts it
+        dealer.status = PlayerStatus.STICK if final else PlayerStatus.LOSE_BUST
+        if self.tracing:
+            logger.debug("Dealer's final points drawn: {}".format(final))
+        return GameStatus.END
+
     def __settlement(self, status):
         """
-        Game settlement.
+        Game settlement, the rewards are given by core.settle_table. Players who are neither busted nor natural end
+        with the status WIN or LOSE.
         :param status: Ending status of the game
         :type status: GameStatus
         :return: rewards, rewards to each gambler.
         :rtype: numpy.array
         """
-        logger.debug("Now come to the settlement section. Player points: {}".format(np.array([p.state.points for p in self.table.players])))
+        players = self.table.players
+        if self.tracing:
+            logger.debug("Now come to the settlement section. Player points: {}".format(self.table.players_points))
+        results = settle_table(status, [player.state.points for player in players],
+                               [player.status for player in players], self.reward_win, self.reward_lose,
+                               self.reward_draw, self.reward_natural)
+
+        for player in players:
+            if player.status not in (PlayerStatus.NATURAL, PlayerStatus.LOSE_BUST):
+                player.status = PlayerStatus.LOSE
         if status == GameStatus.END:
-            players_points = np.array([p.state.points for p in self.table.players])
-            players_points[players_points > 21] = 0  # Eliminate busted points !
-            gamblers_points = players_points[:-1]
-            gambler_status_cnt = Counter(self.table.players_status[:-1])
-            reward = np.zeros(shape=(self.table.n - 1, 1))
-
-        for p in self.table.players:
-            # Player got natural wins, other lose
-            if p.status not in (PlayerStatus.NATURAL, PlayerStatus.LOSE_BUST):
-                p.status = PlayerStatus.LOSE
-
-        if status == GameStatus.DRAW:
-            logger.info("MIRACLE! MIRACLE! MIRACLE!")
-            reward = self.reward_draw * np.ones(shape=(self.table.n - 1, 1))
-        elif status == GameStatus.NATURAL:
-            # Give gamblers win natural reward 1, others -1.
-            logger.info("Some lucky player got natural!")
-            reward = (self.reward_win - self.reward_lose) * (np.array(self.table.players_status[:-1]) ==
-                                                             PlayerStatus.NATURAL).reshape((self.table.n - 1, 1)) + \
-                     self.reward_lose * np.ones((self.table.n - 1, 1))
-            for j in range(self.table.n-1):
-                if self.table.players[j].status == PlayerStatus.NATURAL:
-                    reward[j] = 1.5
-                else:
-                    reward[j] = self.reward_lose
-
-            # reward = (self.reward_win - self.reward_lose) * np.eye(1, self.table.n - 1, winner).T + \
-            #          self.reward_lose * np.ones((self.table.n - 1, 1))
-            # Or give gamblers win natural reward 1, others 0.
-            # self.player_reward += self.reward_win * (self.table.players_status[:-1] == PlayerState.NATURAL)
-        elif status == GameStatus.END:
-            if self.table.players_status[-1] == PlayerStatus.LOSE_BUST:  # If dealer goes bust.
-                if gambler_status_cnt[PlayerStatus.STICK] >= 1:  # There is still any gambler not getting busted
-                    # winner = players_points.argmax()
-                    # logger.info("Dealer goes bust, gambler {} wins!".format(winner))
-                    # self.table.players[winner].status = PlayerStatus.WIN  # Reset winner's status
-                    # Give winner self.reward_win, others self.reward_lose
-                    # reward = (self.reward_win - self.reward_lose) * np.eye(1, self.table.n - 1, winner).T + \
-                    #          self.reward_lose * np.ones((self.table.n - 1, 1))
-                    logger.info("Dealer goes bust, gambler {} wins!".format(np.nonzero(players_points)))
-                    # Give every who wins dealer reward_win, others reward_lose
-                    for j in range(self.table.n-1):
-                        if players_points[j] != 0:
-                            self.table.players[j].status = PlayerStatus.WIN
-                            reward[j] = self.reward_win
-                        else:
-                            reward[j] = self.reward_lose
-                else:
-                    logger.info("Everyone goes bust!")
-                    reward = self.reward_draw * np.ones(shape=(self.table.n - 1, 1))
-                    # reward = np.zeros((self.table.n - 1, 1))
-            else:  # Dealer not bust
-                dealer_point = players_points[-1]
-                max_gambler_point = players_points[:-1].max()
-                # Compare points of gamblers not busted and point of dealer
-                if max_gambler_point < dealer_point:  # Gamblers lose
-                    logger.info("Dealer wins!")
-                    self.table.players[-1].status = PlayerStatus.WIN  # Set dealer's status to win
-                    reward = self.reward_lose * np.ones((self.table.n - 1, 1))
-                elif max_gambler_point == dealer_point:  # Tie
-                    logger.info("The game ended in a tie...")
-                    reward = self.reward_draw * np.ones(shape=(self.table.n - 1, 1))
-                    # reward = np.zeros((self.table.n - 1, 1))
-                else:  # Some gambler wins
-                    # winner = players_points.argmax()
-                    # logger.info("Gambler {}'s point is closer to 21, and he wins!".format(winner))
-                    # reward = (self.reward_win - self.reward_lose) * np.eye(1, self.table.n - 1, winner).T + \
-                    #          self.reward_lose * np.ones((self.table.n - 1, 1))
-                    # self.table.players[winner].status = PlayerStatus.WIN
-                    logger.info("Gambler {}s' points are closer to 21 than dealer's and they win!".format((gamblers_points-dealer_point) >= 0))
-                    for j in range(self.table.n-1):
-                        if players_points[j] - dealer_point >= 0:
-                            reward[j] = self.reward_win
-                            self.table.players[j].status = PlayerStatus.WIN
-                        else:
-                            reward[j] = self.reward_lose
-
-        return reward
-
+            for player, result in zip(players, results):
+                if result == self.reward_win:
+                    player.status = PlayerStatus.WIN
+            if results.count(self.reward_lose) == len(results):  # The dealer beats every gambler
+                players[-1].status = PlayerStatus.WIN
+        if self.tracing:
+            logger.info("Settled {} with rewards {}.".format(GameStatus(status).name, results))
+        return np.array(results, dtype=float).reshape((self.table.n - 1, 1))
 
     def play(self, model):
         """
@@ -298,8 +327,18 @@ class Blackjack:
         :return: Game ending status, rewards, player_trajectorys
         :rtype: GameStatus, numpy.array, List[List[(player_sum, dealer_showing, usable_ace)]]
         """
-        logger.info("Game starts with {} decks of cards and {} players.".format(self.table.m if self.table.m > 0 else "infinite",
-                                                                                self.table.n))
+        self.episode += 1
+        if isinstance(self.trace, bool):
+            selected = self.trace
+        elif callable(self.trace):
+            selected = self.trace(self.episode)
+        else:
+            selected = self.episode in self.trace
+        self.tracing = False
+        if selected:
+            # Loguru calls the lazy arguments only when it emits the message, which starts tracing the episode
+            logger.opt(lazy=True).info("Game starts with {} decks of cards and {} players.", self.__start_tracing,
+                                       lambda: self.table.n)
         player_trajectory = [[] for i in range(self.table.n-1)]
 
         self.reset()
@@ -317,24 +356,30 @@ class Blackjack:
                 action = model.predict(state=self.__observe())
                 player_trajectory[self.act].append((self.__observe(), action))
 
-            logger.info("Finish with status {} and total reward {}.".format(GameStatus(status).name, reward))
+            if self.tracing:
+                logger.info("Finish with status {} and total reward {}.".format(GameStatus(status).name, reward))
+            if self.recorder is not None:
+                self.recorder.watch(reward, player_trajectory)
             return status, reward, player_trajectory
 
         observation = self.__observe()
         while True:
             player = self.table.players[self.act]
 
-            while player.state.points < 12: # if sum of player is less than 12, always hit
-                player.draw(self.table.decks.dealCard(n=1))
-                observation = self.__observe()
-
-            if self.act == self.table.n-1:
-                action = DealerPolicy.predict(state=observation)
+            if self.act == self.table.n-1 and self.dealer_outcomes is not None:
+                status = self.__sample_dealer(player)
             else:
-                action = model.predict(state=observation)
-                player_trajectory[self.act].append((observation, action))
+                while player.state.points < 12: # if sum of player is less than 12, always hit
+                    player.draw_codes(self.table.decks.deal(n=1))
+                    observation = self.__observe()
+
+                if self.act == self.table.n-1:
+                    action = DealerPolicy.predict(state=observation)
+                else:
+                    action = model.predict(state=observation)
+                    player_trajectory[self.act].append((observation, action))
 
-            observation, status = self.step(action)
+                observation, status = self.step(action)
             # self.record(observation)
 
             # if status == GameStatus.END:
@@ -343,11 +388,40 @@ class Blackjack:
                 reward = self.__settlement(status)
 
                 # self.player_reward += reward
-                logger.info("Game ends with points {}, result {}, total reward {}".format(
-                    [p.state.points for p in self.table.players],
-                    [PlayerStatus(ps).name for ps in self.table.players_status],
-                    self.player_reward.T))
-
-                # self.recorder.val = reward
+                if self.tracing:
+                    logger.info("Game ends with points {}, result {}, total reward {}".format(
+                        [p.state.points for p in self.table.players],
+                        [PlayerStatus(ps).name for ps in self.table.players_status],
+                        self.player_reward.T))
+
+                if self.recorder is not None:
+                    self.recorder.watch(reward, player_trajectory)
                 return status, reward, player_trajectory
 
+    def stream(self, model, episodes, chunk_size=65536):
+        """
+        Play episodes and stream the decisions of all gamblers as records of EXPERIENCE_DTYPE,
+        in chunks of chunk_size records (the last one may be shorter), so that memory does not grow with episodes.
+        :param model: The model for gambler's action.
+        :type model: AbstractModel
+        :param episodes: number of episodes to play.
+        :type episodes: int
+        :param chunk_size: number of records in a chunk.
+        :type chunk_size: int
+        :return: generator of record arrays
+        :rtype: Iterator[numpy.array]
+        """
+        chunk = np.empty(chunk_size, dtype=EXPERIENCE_DTYPE)
+        k = 0
+        for episode in range(episodes):
+            _, rewards, player_trajectory = self.play(model)
+            for j, trajectory in enumerate(player_trajectory):
+                for obs, action in trajectory:
+                    chunk[k] = (episode, j, obs[0], obs[1], obs[2], action, rewards[j, 0])
+                    k += 1
+                    if k == chunk_size:
+                        yield chunk
+                        chunk = np.empty(chunk_size, dtype=EXPERIENCE_DTYPE)
+                        k = 0
+        if k:
+            yield chunk[:k]
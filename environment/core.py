@@ -1,3 +1,4 @@
+import json
 import numpy as np
 from loguru import logger
 from enum import IntEnum
@@ -37,8 +38,17 @@ class UsableAce(IntEnum):
     USABLE = 1
 
 
+# Record of one decision made by a gambler, as streamed by Blackjack.stream:
+# episode id, player index, observation (PlayerSum, DealerShow, UsableAce), action and the final reward of the player.
+EXPERIENCE_DTYPE = np.dtype([("episode", np.int64), ("player", np.int8),
+                             ("player_sum", np.int8), ("dealer_show", np.int8), ("usable_ace", np.int8),
+                             ("action", np.int8), ("reward", np.float32)])
+
+
 class Card(object):
     """A basic Card class with sum method for the convenience of Blackjack game.
+    In the dealing path cards are represented by their integer code (value - 1) * 4 + suit index, i.e. 0 to 51,
+    Card objects are only built on demand for logging and display.
     """
     suits = ["spades", "hearts", "diamonds", "clubs"]
     values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13]
@@ -50,6 +60,14 @@ class Card(object):
         self.value = v
         self.suit = s
 
+    @classmethod
+    def from_code(cls, code):
+        return cls(code // 4 + 1, cls.suits[code % 4])
+
+    @property
+    def code(self):
+        return (self.value - 1) * 4 + (Card.suits.index(self.suit) if self.suit in Card.suits else 0)
+
     @classmethod
     def sum(cls, cards, discard=True):
         """
@@ -59,48 +77,297 @@ class Card(object):
             return 0
         else:
             # return sum([11 if card.suit == 'usble_ace' else 10 if card.value > 10 else card.value for card in cards])
-            return sum([card.value if card.value <= 10 else 10 for card in cards])
+            return sum(card.value if card.value <= 10 else 10 for card in cards)
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             raise Exception("{} and {} objects are not comparable!".format(self.__class__.__name__,
                                                                            other.__class__.__name__))
-        return self.value == other.value and self.suits == other.suits
+        return self.value == other.value and self.suit == other.suit
 
     def __hash__(self):
-        # Redefine the hash function, to hash the representation of object
-        # So that in the Player.draw() method, we can check if the player holds aces.
-        return hash(self.__repr__())
+        # Hash the value and suit, so that in the Player.draw() method, we can check if the player holds aces.
+        return hash((self.value, self.suit))
 
     def __repr__(self):
         return "({}, {})".format(self.value, self.suit)
 
 
+# Points of every card code, cards greater than 10 are counted as 10 and aces as 1.
+CARD_POINTS = tuple(min(code // 4 + 1, 10) for code in range(52))
+# Card codes 0 to 3 are the aces.
+ACE_CODES = 4
+
+
+def settle(game_status, points, status, win=1, lose=-1, draw=0, natural=1.5):
+    """
+    Rewards of the gamblers of a batch of tables (leading dimensions), the dealer being the last player of a table.
+    With busted points counted as 0, all the cases reduce to one rule on the best gambler's points and the dealer's:
+        DRAW at dealing:        everyone draws
+        NATURAL at dealing:     gamblers with a natural get `natural`, the others lose
+        best == dealer:         everyone draws, including when the dealer and all the gamblers go bust
+        otherwise:              gamblers reaching the dealer's points win, the others lose. A busted dealer is
+                                reached by any gambler not busted, and when best < dealer nobody reaches them
+    :param game_status: ending GameStatus of every table, shape (...)
+    :type game_status: numpy.array
+    :param points: points of every player, busted ones included, shape (..., n)
+    :type points: numpy.array
+    :param status: PlayerStatus of every player, shape (..., n), only the naturals are read from it.
+    :type status: numpy.array
+    :return: reward of every gambler, shape (..., n-1)
+    :rtype: numpy.array
+    """
+    points = np.asarray(points)
+    points = points * (points <= 21)  # Eliminate busted points !
+    gamblers, dealer = points[..., :-1], points[..., -1:]
+    best = gamblers.max(axis=-1, keepdims=True)
+    # Outcome of every gambler: 0 lose, 1 draw, 2 win, 3 natural
+    outcome = np.where(best == dealer, 1, 2 * (gamblers >= np.maximum(dealer, 1)))
+    game_status = np.asarray(game_status)[..., None]
+    if game_status.any():  # Some table was settled at dealing (GameStatus.END is 0)
+        dealt = np.where(game_status == int(GameStatus.NATURAL),
+                         3 * (np.asarray(status)[..., :-1] == int(PlayerStatus.NATURAL)), 1)
+        outcome = np.where(game_status == int(GameStatus.END), outcome, dealt)
+    return np.array((lose, draw, win, natural), dtype=float)[outcome]
+
+
+def settle_table(game_status, points, status, win=1, lose=-1, draw=0, natural=1.5) -> list:
+    """
+    The rule of settle for a single table, on plain sequences: with the handful of players of a table, calling NumPy
+    costs more than the comparisons themselves.
+    :return: reward of every gambler
+    :rtype: list
+    """
+    if game_status == GameStatus.DRAW:
+        return [draw] * (len(points) - 1)
+    if game_status == GameStatus.NATURAL:
+        return [natural if s == PlayerStatus.NATURAL else lose for s in status[:-1]]
+    gamblers = [p if p <= 21 else 0 for p in points[:-1]]
+    dealer = points[-1] if points[-1] <= 21 else 0
+    if max(gamblers) == dealer:
+        return [draw] * len(gamblers)
+    dealer = max(dealer, 1)
+    return [win if p >= dealer else lose for p in gamblers]
+
+
+def default_rng(seed=None) -> np.random.Generator:
+    """
+    Random generator of a game or a model.
+    :param seed: a Generator (used as is), a seed or a SeedSequence to start a new one, or None to start a new one
+        seeded from NumPy's global state, so that np.random.seed() still makes the runs reproducible.
+    :type seed: Union[None, int, numpy.random.SeedSequence, numpy.random.Generator]
+    :rtype: numpy.random.Generator
+    """
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int64).max)
+    return np.random.default_rng(seed)
+
+
+class RandomBuffer(object):
+    """
+    Uniform random numbers drawn from a Generator in blocks of block_size and served one by one: a scalar call to
+    the Generator costs microseconds, serving a number from the block a fraction of it.
+    Integers are derived from the uniforms, with the same distribution as rng.integers (up to the 53 bits precision
+    of the uniforms).
+    """
+    def __init__(self, rng=None, block_size=4096):
+        """
+        :param rng: random generator or its seed, see default_rng.
+        :type rng: numpy.random.Generator
+        :param block_size: number of uniforms drawn at once.
+        :type block_size: int
+        """
+        self.rng = default_rng(rng)
+        self.uniforms = np.empty(block_size)
+        self.position = block_size  # next uniform served, the block is drawn when first needed
+
+    def __getstate__(self):
+        # Only the numbers not served yet are kept
+        return {"rng": self.rng, "block_size": len(self.uniforms), "rest": self.uniforms[self.position:].copy()}
+
+    def __setstate__(self, state):
+        self.rng = state["rng"]
+        self.uniforms = np.empty(state["block_size"])
+        self.position = len(self.uniforms) - len(state["rest"])
+        self.uniforms[self.position:] = state["rest"]
+
+    def checkpoint(self) -> dict:
+        """
+        State of the generator and of the block, restore() serves the same numbers again.
+        """
+        return {"rng": json.dumps(self.rng.bit_generator.state), "uniforms": self.uniforms.copy(),
+                "position": self.position}
+
+    def restore(self, state: dict):
+        # The generator is restored in place, as it may be shared with other buffers
+        self.rng.bit_generator.state = json.loads(str(state["rng"]))
+        self.uniforms = np.array(state["uniforms"], dtype=float)
+        self.position = int(state["position"])
+
+    def refill(self):
+        self.rng.random(out=self.uniforms)
+        self.position = 0
+
+    def reserve(self, k):
+        """
+        Make sure the next k numbers are in the block, for code serving them without the generator (see
+        numba_engine.py). The numbers served do not change: the generator gives the same sequence whatever the blocks
+        it is drawn in.
+        """
+        rest = len(self.uniforms) - self.position
+        if rest < k:
+            uniforms = np.empty(max(len(self.uniforms), k))
+            uniforms[:rest] = self.uniforms[self.position:]
+            self.rng.random(out=uniforms[rest:])
+            self.uniforms, self.position = uniforms, 0
+
+    def take(self, k) -> np.ndarray:
+        """
+        The next k numbers at once, as a view of the block.
+        """
+        self.reserve(k)
+        self.position += k
+        return self.uniforms[self.position - k:self.position]
+
+    def random(self) -> float:
+        """
+        A uniform random number in [0, 1).
+        """
+        if self.position == len(self.uniforms):
+            self.refill()
+        self.position += 1
+        return self.uniforms[self.position - 1]
+
+    def integers(self, high) -> int:
+        """
+        A uniform random integer in [0, high).
+        """
+        return int(self.random() * high)
+
+
 class Decks(object):
+    """
+    m decks of cards (infinite when m = 0).
+    By default the shoe is rebuilt for every episode and cards are picked at random from it. With a penetration,
+    the shoe is shuffled once and cards are dealt by advancing a cursor, the same shoe carrying across episodes
+    until the cut card (penetration * number of cards) is reached, as in a casino.
+    """
     one_deck = [Card(v, s) for v, s in itertools.product(Card.values, Card.suits)]
+    one_deck_codes = np.arange(52, dtype=np.uint8)
     aces = set([Card(1, s) for s in Card.suits])
-    def __init__(self, m: int):
+    def __init__(self, m: int, penetration: float = None, rng=None):
+        """
+        :param m: deck of cards, 0 indicates infinity, negative value is invalid.
+        :type m: int
+        :param penetration: fraction of the shoe dealt before reshuffling, None to rebuild the shoe every episode.
+        :type penetration: float
+        :param rng: random generator dealing the cards, or its seed, see default_rng.
+        :type rng: numpy.random.Generator
+        """
         assert m >= 0, "Negative decks of cards is invalid!"
+        assert penetration is None or 0 < penetration <= 1, "Penetration must be in (0, 1]!"
         self.m = m
+        self.penetration = penetration if m > 0 else None
+        self.rng = rng
         self.reset(self.m)
 
+    @property
+    def rng(self):
+        return self.random.rng
+
+    @rng.setter
+    def rng(self, rng):
+        # Cards are picked with uniforms drawn in blocks
+        self.random = RandomBuffer(rng)
+
     def reset(self, m: int):
         if m == 0:
-            self.cardset = Decks.one_deck.copy()
+            self.cardset = Decks.one_deck_codes
         else:
-            self.cardset = np.repeat(Decks.one_deck, repeats=m, axis=0).tolist()
+            self.cardset = np.tile(Decks.one_deck_codes, m)
             # np.random.shuffle(self.cardset)  # No need to shuffle
+        self.size = len(self.cardset)
+        if self.penetration is not None:
+            self.shuffle()
 
-    def dealCard(self, n=1) -> List[Card]:
-        # Pop cards with/without replacement according to deck of cards (m)
-        card = []
+    def shuffle(self):
+        """
+        Shuffle the whole shoe and put the cut card. The cards are sorted by uniforms of the random buffer, so that
+        all the numbers of the decks come from the buffer (the compiled engine shuffles alike, see numba_engine.py).
+        """
+        self.cardset[:] = self.cardset[np.argsort(self.random.take(len(self.cardset)))]
+        self.cursor = 0
+        self.start = 0  # first card of the round
+        self.cut = int(self.penetration * len(self.cardset))
+
+    def reshuffle(self):
+        """
+        Shuffle the cards out of play (the discards and the cards not dealt yet) when the shoe runs out in the middle
+        of a round. The cards of the round stay in the hands, they are moved to the front of the shoe as dealt.
+        The cards are shuffled with the random buffer, as shuffle() does.
+        """
+        in_play = self.cardset[self.start:self.cursor].copy()
+        rest = np.concatenate((self.cardset[:self.start], self.cardset[self.cursor:]))
+        self.cardset[:len(in_play)] = in_play
+        self.cardset[len(in_play):] = rest[np.argsort(self.random.take(len(rest)))]
+        self.start, self.cursor = 0, len(in_play)
+
+    def checkpoint(self) -> dict:
+        """
+        State of the decks between two episodes, restore() deals the same cards again.
+        """
+        state = {"random": self.random.checkpoint(), "size": self.size}
+        if self.m > 0:
+            state["cardset"] = self.cardset.copy()
+        if self.penetration is not None:
+            state["cursor"], state["cut"] = self.cursor, self.cut
+        return state
+
+    def restore(self, state: dict):
+        self.random.restore(state["random"])
+        self.size = int(state["size"])
+        if self.m > 0:
+            self.cardset[:] = state["cardset"]
+        if self.penetration is not None:
+            self.cursor, self.cut = int(state["cursor"]), int(state["cut"])
+            self.start = self.cursor
+
+    def next_round(self):
+        """
+        Prepare the decks for a new episode.
+        """
+        if self.penetration is None:
+            self.reset(self.m)
+        elif self.cursor >= self.cut:
+            self.shuffle()
+        else:
+            self.start = self.cursor
+
+    def deal(self, n=1) -> List[int]:
+        """
+        Deal n cards with/without replacement according to deck of cards (m), and return their codes.
+        """
+        if self.penetration is not None:
+            if self.cursor + n > len(self.cardset):
+                # The shoe runs out in the middle of an episode, the cards in hand are not shuffled again.
+                self.reshuffle()
+                assert self.cursor + n <= len(self.cardset), "Not enough cards in the shoe for the round!"
+            self.cursor += n
+            return self.cardset[self.cursor - n:self.cursor].tolist()
+
+        codes = []
         for i in range(n):
-            idx = np.random.choice(len(self.cardset))
-            card.append(self.cardset[idx])
+            idx = self.random.integers(self.size)
+            codes.append(int(self.cardset[idx]))
             if self.m > 0:
-                self.cardset.pop(idx)
+                # Remove the card dealt by moving the last remaining card to its place
+                self.size -= 1
+                self.cardset[idx] = self.cardset[self.size]
+        return codes
 
-        return card
+    def dealCard(self, n=1) -> List[Card]:
+        # Pop cards with/without replacement according to deck of cards (m)
+        return [Card.from_code(code) for code in self.deal(n)]
 
 # dc = Decks(3)
 # print(len(dc.cardset))
@@ -113,12 +380,26 @@ class PlayerState(object):
         self.reset()
 
     def reset(self):
-        self.hand = []
+        self.codes = []
+        self.raw = 0  # sum of cards in hand, aces are counted as 1
+        self.has_ace = False
         self.usable_ace = UsableAce.NO_USABLE
         self.update_points()
 
+    @property
+    def hand(self) -> List[Card]:
+        """
+        Cards in hand, built from their codes. The first ace is labelled as usable or not.
+        """
+        hand = [Card.from_code(code) for code in self.codes]
+        for card in hand:
+            if card.value == 1:
+                card.suit = "usable_ace" if self.usable_ace == UsableAce.USABLE else "no_usable_ace"
+                break
+        return hand
+
     def update_points(self):
-        self.points = Card.sum(self.hand)
+        self.points = self.raw
         if self.usable_ace == UsableAce.USABLE and self.points+10 <= 21:
             self.points += 10
 
@@ -151,26 +432,30 @@ class Player(object):
         self.reset()
 
     def draw(self, card: List[Card]):
-        self.state.hand.extend(card)
-        self.state.update_points()
+        self.draw_codes([c.code for c in card])
+
+    def draw_codes(self, codes: List[int]):
+        state = self.state
+        for code in codes:
+            state.raw += CARD_POINTS[code]
+            if code < ACE_CODES:
+                state.has_ace = True
+        state.codes.extend(codes)
+        state.update_points()
         if self.points > 21:
             self.status = PlayerStatus.LOSE_BUST
 
         # TODO: usable ace: there is an Ace in self.state.hand and self.state.points+10 <= 21:
-        if [hc for hc in self.state.hand if hc.value==1]: # Decks.aces & set(self.state.hand):  # If player has Ace
-            hand_1st_ace = [hc for hc in self.state.hand if hc.value==1][0] # next(iter(Decks.aces & set(self.state.hand)))  # first ace in hand
+        if state.has_ace:  # If player has Ace
             if self.points + 10 <= 21:
-                # hand_ace.value = 11
-                hand_1st_ace.suit = "usable_ace"
-                self.state.usable_ace = UsableAce.USABLE
+                state.usable_ace = UsableAce.USABLE
             else:
-                hand_1st_ace.suit = "no_usable_ace"
-                self.state.usable_ace = UsableAce.NO_USABLE
-            self.state.update_points()
+                state.usable_ace = UsableAce.NO_USABLE
+            state.update_points()
 
-        if self.points + 10 == 21 and len(self.state.hand) == 2 and self.state.usable_ace == UsableAce.USABLE:
+        if self.points + 10 == 21 and len(state.codes) == 2 and state.usable_ace == UsableAce.USABLE:
             # hand_1st_ace.value = 11
-            self.state.update_points()
+            state.update_points()
             self.status = PlayerStatus.NATURAL
 
     @property
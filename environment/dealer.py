@@ -0,0 +1,211 @@
+"""
+Distribution of the dealer's final points, to settle a round without playing the dealer's turn card by card.
+
+The dealer follows a fixed policy (DealerPolicy: stick on any sum of 17 or greater), so once the gamblers are done,
+only the final points of the dealer matter. They depend on the dealer's hand and on the cards left:
+    infinite deck (m = 0):  exact distributions, computed once per hand and cached for good
+    finite decks:           distributions given the composition of the shoe (number of cards left of every value),
+                            exact with the default resolution of 1. A coarser resolution counts the cards in steps of
+                            `resolution` to make a compact signature, so that the shoes of close compositions share an
+                            approximate distribution. They are cached with LRU eviction.
+DealerOutcomes.sample draws the final points at once, see Blackjack(sample_dealer=True), which only samples them with
+an infinite deck: with finite decks a lookup costs more than playing the dealer's turn.
+"""
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from environment.core import CARD_POINTS, Decks, RandomBuffer
+
+# Probability of drawing a card of value 1 (Ace), 2, ..., 10 from an infinite deck, face cards are counted as 10.
+CARD_PROBABILITY = np.array([4] * 9 + [16]) / 52
+DEALER_OUTCOMES = [17, 18, 19, 20, 21, 0]  # Final points of the dealer, 0 for going bust
+# Value of every card code, to count the cards left in a shoe
+_CARD_VALUES = np.array(CARD_POINTS, dtype=np.int64)
+
+
+def draw(state, cards):
+    """
+    Hand state (raw, usable, has_ace) after drawing cards at once, following Player.draw:
+    raw is the sum of cards with aces counted as 1, and the first ace becomes usable only if it was not before.
+    """
+    raw, usable, has_ace = state
+    raw += sum(cards)
+    has_ace = has_ace or 1 in cards
+    return raw, has_ace and raw <= 11 and not usable, has_ace
+
+
+def points(state):
+    return state[0] + 10 * state[1]
+
+
+@lru_cache(maxsize=None)
+def dealer_outcome(state):
+    """
+    Distribution of the dealer's final points (see DEALER_OUTCOMES), the dealer sticks on any sum of 17 or greater.
+    """
+    if state[0] > 21:
+        return np.eye(len(DEALER_OUTCOMES))[-1]
+    if points(state) >= 17:
+        return np.eye(len(DEALER_OUTCOMES))[DEALER_OUTCOMES.index(points(state))]
+    return sum(p * dealer_outcome(draw(state, (v,))) for v, p in enumerate(CARD_PROBABILITY, 1))
+
+
+def dealer_distribution(show):
+    """
+    Distribution of the dealer's final points given his face up card, with an infinite deck.
+    :param show: value of dealer's face up card, 1 to 10.
+    :type show: int
+    :return: probabilities of the final points 17, 18, 19, 20, 21 and going bust.
+    :rtype: numpy.array
+    """
+    return sum(p * dealer_outcome(draw((0, False, False), (show, v))) for v, p in enumerate(CARD_PROBABILITY, 1))
+
+
+# Distribution of a dealer's hand that is over, as a tuple
+_FINAL = {p: tuple(float(p == outcome) for outcome in DEALER_OUTCOMES) for p in DEALER_OUTCOMES}
+
+
+def shoe_outcome(state, counts, memo):
+    """
+    Distribution of the dealer's final points when the cards are drawn without replacement from a shoe.
+    :param state: dealer's hand (raw, usable, has_ace)
+    :param counts: number of cards left of every value 1 to 10
+    :type counts: tuple
+    :param memo: distributions of the (state, counts) already computed, completed with the ones computed here.
+    :type memo: dict
+    :return: probabilities of DEALER_OUTCOMES
+    :rtype: tuple
+    """
+    if state[0] > 21:
+        return _FINAL[0]
+    if points(state) >= 17:
+        return _FINAL[points(state)]
+    key = (state, counts)
+    distribution = memo.get(key)
+    if distribution is None:
+        total = sum(counts)
+        distribution = [0.0] * len(DEALER_OUTCOMES)
+        for v, count in enumerate(counts, 1):
+            if count:
+                left = counts[:v - 1] + (count - 1,) + counts[v:]
+                weight = count / total
+                distribution = [d + weight * p
+                                for d, p in zip(distribution, shoe_outcome(draw(state, (v,)), left, memo))]
+        distribution = memo[key] = tuple(distribution)
+    return distribution
+
+
+@lru_cache(maxsize=None)
+def _infinite_outcome(state):
+    return tuple(dealer_outcome(state).tolist())
+
+
+class DealerOutcomes(object):
+    """
+    Cache of the distributions of the dealer's final points, for the decks of a table. With finite decks they are
+    keyed by the dealer's hand and the composition of the shoe rounded to `resolution` cards, and the distributions
+    met while computing one (the hands after every card drawn) are kept as well, so that shoes sharing cards share
+    their computations. The least recently used ones are evicted beyond maxsize, hits and misses count the lookups.
+    """
+    def __init__(self, decks: Decks, maxsize=2**17, resolution=1):
+        """
+        :param decks: the decks dealing the cards, read when looking up a distribution.
+        :type decks: Decks
+        :param maxsize: number of distributions kept for finite decks.
+        :type maxsize: int
+        :param resolution: step of the counts of cards in the signature of a shoe, 1 (exact) by default. A step of
+            the number of decks raises the hit rate of the cache, at the cost of rounded distributions.
+        :type resolution: int
+        """
+        self.decks = decks
+        self.maxsize = maxsize
+        self.resolution = resolution
+        self.cache = OrderedDict()  # (state, counts): distribution
+        self.hits = 0
+        self.misses = 0
+
+    def counts(self):
+        """
+        Number of cards left of every value 1 to 10, in the part of the shoe not dealt yet.
+        """
+        decks = self.decks
+        if decks.penetration is None:
+            left = decks.cardset[:decks.size]
+        else:
+            left = decks.cardset[decks.cursor:]
+        return tuple(np.bincount(_CARD_VALUES[left], minlength=11)[1:].tolist())
+
+    def signature(self, counts):
+        """
+        The composition standing for the given one in the cache, counts rounded to a multiple of the resolution.
+        """
+        step = self.resolution
+        if step == 1:
+            return counts
+        return tuple((count + step // 2) // step * step for count in counts)
+
+    def lookup(self, state, counts=None):
+        """
+        Distribution of the dealer's final points given the dealer's hand and the cards left (their signature).
+        :param state: dealer's hand (raw, usable, has_ace)
+        :param counts: number of cards left of every value 1 to 10, by default the ones left in the decks.
+        :type counts: tuple
+        :return: probabilities of DEALER_OUTCOMES
+        :rtype: tuple
+        """
+        if self.decks.m == 0:
+            return _infinite_outcome(state)
+        key = (state, self.signature(self.counts() if counts is None else counts))
+        distribution = self.cache.get(key)
+        if distribution is None:
+            self.misses += 1
+            distribution = shoe_outcome(state, key[1], self.cache)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return distribution
+
+    def distribution(self, state):
+        """
+        Probabilities of the final points 17, 18, 19, 20, 21 and going bust, given the dealer's hand.
+        :rtype: numpy.array
+        """
+        return np.array(self.lookup(state))
+
+    def by_up_card(self, show):
+        """
+        Distribution of the dealer's final points given the face up card only: the hole card is drawn from the cards
+        left (the face up card is not one of them any more). Every hole card counts, the ones making 21 included, since
+        the engines never end a round on a natural of the dealer (Player.draw_codes does not detect naturals).
+        :param show: value of dealer's face up card, 1 to 10.
+        :type show: int
+        :rtype: numpy.array
+        """
+        counts = None if self.decks.m == 0 else self.counts()
+        distribution, total = 0, 0
+        for v, weight in enumerate(CARD_PROBABILITY if counts is None else counts, 1):
+            hand = draw((0, False, False), (show, v))
+            if weight:
+                left = None if counts is None else counts[:v - 1] + (counts[v - 1] - 1,) + counts[v:]
+                distribution = distribution + weight * np.array(self.lookup(hand, left))
+                total += weight
+        return distribution / total
+
+    def sample(self, state, random: RandomBuffer):
+        """
+        Final points of the dealer, drawn at once from the distribution given the dealer's hand.
+        :param state: dealer's hand (raw, usable, has_ace)
+        :param random: random buffer of the draw.
+        :type random: RandomBuffer
+        :return: one of DEALER_OUTCOMES, 0 for going bust
+        :rtype: int
+        """
+        u = random.random()
+        for outcome, p in zip(DEALER_OUTCOMES, self.lookup(state)):
+            u -= p
+            if u < 0:
+                return outcome
+        return DEALER_OUTCOMES[-1]  # rounding errors
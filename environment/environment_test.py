@@ -1,5 +1,7 @@
+import pickle
 import unittest
-from core import Card
+import numpy as np
+from core import Card, CARD_POINTS, Decks, Player, RandomBuffer, UsableAce
 
 
 class EnvironmentTest(unittest.TestCase):
@@ -11,7 +13,51 @@ class EnvironmentTest(unittest.TestCase):
         s2 = Card(2, "spade")
         self.assertEqual(Card.sum([s1, s2]), 3)
 
+    def test_card_code(self):
+        for code in range(52):
+            card = Card.from_code(code)
+            self.assertEqual(card.code, code)
+            self.assertEqual(CARD_POINTS[code], Card.sum([card]))
 
+    def test_draw_codes(self):
+        player = Player()
+        player.draw_codes([0, 16])  # Ace and 5
+        self.assertEqual((player.points, player.state.usable_ace), (16, UsableAce.USABLE))
+        self.assertEqual(player.state.hand[0].suit, "usable_ace")
+        player.draw([Card(3, "spades")])
+        self.assertEqual((player.points, player.state.usable_ace), (9, UsableAce.NO_USABLE))
+
+
+    def test_shoe(self):
+        decks = Decks(1, penetration=0.5)
+        codes = decks.deal(26)
+        decks.next_round()  # cut card reached, reshuffle
+        self.assertEqual(decks.cursor, 0)
+        codes = decks.deal(20) + decks.deal(32)
+        self.assertEqual(sorted(codes), list(range(52)))
+        decks.next_round()
+        self.assertEqual(decks.cursor, 0)
+
+    def test_shoe_reshuffle(self):
+        decks = Decks(1, penetration=1)
+        decks.deal(45)
+        decks.next_round()  # cut card not reached, the round starts at card 45
+        codes = decks.deal(4) + decks.deal(6)  # the shoe runs out, only the discards are shuffled again
+        self.assertEqual(len(set(codes)), 10)
+        self.assertEqual(decks.cursor, 10)
+        self.assertEqual(sorted(decks.cardset.tolist()), list(range(52)))
+
+    def test_random_buffer(self):
+        buffer = RandomBuffer(np.random.default_rng(0), block_size=100)
+        uniforms = [buffer.random() for i in range(150)]  # across two blocks
+        rng = np.random.default_rng(0)
+        self.assertEqual(uniforms, rng.random(200)[:150].tolist())
+        copy = pickle.loads(pickle.dumps(buffer))
+        self.assertEqual([copy.random() for i in range(100)], [buffer.random() for i in range(100)])
+        buffer.reserve(80)  # the numbers served go on across the blocks
+        self.assertEqual(buffer.uniforms[buffer.position:buffer.position + 80].tolist(), rng.random(130)[50:].tolist())
+        cards = np.bincount([buffer.integers(52) for i in range(52000)], minlength=52)
+        self.assertTrue(np.all(np.abs(cards - 1000) < 150))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,169 @@
+"""
+Gymnasium-style interface of the Blackjack game, for agents choosing the actions themselves instead of being called
+back by Blackjack.play.
+
+The agent plays the first gambler of the table. Once it sticks or goes bust, the other gamblers play with a fixed
+model, then the dealer, and the round is settled. A step is one decision of the agent:
+    observation: integer array (PlayerSum, DealerShow, UsableAce), sums below 12 are always hit before asking
+    reward:      0 until the last step of the round, then the reward of the agent
+A round ending right after dealing (natural) still asks for one decision, whose action is ignored, as Blackjack.play
+records one. BlackjackVectorEnv steps many tables in lockstep on the arrays of BatchBlackjack. When Gymnasium is
+installed (pip install gymnasium), BlackjackEnv is a gymnasium.Env and both have Gymnasium spaces.
+"""
+import numpy as np
+from environment.core import Action, GameStatus, PlayerStatus, default_rng
+from environment.blackjack import Table
+from environment.batch_blackjack import BatchBlackjack
+from model.abstract_model import AbstractModel, TestModel
+
+try:
+    import gymnasium
+    from gymnasium import spaces
+    GYMNASIUM = True
+except ImportError:
+    GYMNASIUM = False
+
+# Upper bounds (excluded) of PlayerSum, DealerShow and UsableAce, the sum of a bust hand can reach 31
+OBSERVATION_HIGH = np.array([32, 11, 2])
+
+
+class BlackjackVectorEnv(object):
+    """
+    num_envs tables stepped in lockstep, following the API of gymnasium.vector.VectorEnv:
+        reset(seed) -> observations (num_envs, 3), info
+        step(actions) -> observations, rewards, terminated, truncated, info, arrays of num_envs elements
+    With autoreset, a table whose round ends is dealt a new round in the same step: its observation is the first one
+    of the new round, and the last one of the ended round is given in info["final_observation"] (Gymnasium < 1.0).
+    info["_final_observation"] flags the tables concerned, and info["status"] gives the GameStatus of their rounds.
+    """
+    def __init__(self, table: Table, num_envs=1, others: AbstractModel = None, autoreset=True, rng=None):
+        """
+        :param table: Table providing the deck of cards (m) and the number of players (n).
+        :type table: Table
+        :param num_envs: number of tables.
+        :type num_envs: int
+        :param others: model of the other gamblers of the table, TestModel by default.
+        :type others: AbstractModel
+        :param autoreset: whether a round is dealt again as soon as it ends.
+        :type autoreset: bool
+        :param rng: random generator dealing the cards, or its seed, by default the one of the table.
+        :type rng: numpy.random.Generator
+        """
+        self.game = BatchBlackjack(table, batch_size=num_envs, rng=rng)
+        self.num_envs = num_envs
+        self.others = TestModel() if others is None else others
+        self.autoreset = autoreset
+        self.round_status = np.full(num_envs, GameStatus.PLAYING, dtype=np.int64)
+        if GYMNASIUM:
+            self.single_observation_space = spaces.MultiDiscrete(OBSERVATION_HIGH)
+            self.single_action_space = spaces.Discrete(2)
+            self.observation_space = spaces.MultiDiscrete(np.tile(OBSERVATION_HIGH, (num_envs, 1)))
+            self.action_space = spaces.MultiDiscrete([2] * num_envs)
+
+    def observe(self):
+        return self.game.observe(np.arange(self.num_envs), 0)
+
+    def reset(self, seed=None, options=None):
+        """
+        Deal a new round on every table.
+        :param seed: seed of a new random generator dealing the cards, optional.
+        :return: observations of the agent, info
+        """
+        if seed is not None:
+            self.game.rng = default_rng(seed)
+        self.game.reset()
+        self.__start(np.arange(self.num_envs))
+        return self.observe(), {}
+
+    def __start(self, rows):
+        # Rounds just dealt on the given tables: hit while the sum of the agent is below 12
+        self.round_status[rows] = self.game.game_status()[rows]
+        self.__hit_low(rows[self.round_status[rows] == GameStatus.END])
+
+    def __hit_low(self, rows):
+        game = self.game
+        low = rows[(game.status[rows, 0] == PlayerStatus.PLAYING) & (game.points_of(rows, 0) < 12)]
+        while low.size:
+            game.draw(low, 0, [game.deal(low)])
+            low = low[(game.status[low, 0] == PlayerStatus.PLAYING) & (game.points_of(low, 0) < 12)]
+
+    def step(self, actions):
+        """
+        :param actions: action of the agent on every table, Action.HIT (0) or Action.STICK (1).
+        :type actions: numpy.array
+        :return: observations (num_envs, 3), rewards, terminated, truncated and info
+        """
+        game = self.game
+        actions = np.asarray(actions)
+        ended = self.round_status != GameStatus.PLAYING
+        ended &= self.round_status != GameStatus.END  # rounds ended at dealing, whatever the action
+        playing = np.flatnonzero((self.round_status == GameStatus.END) & (game.status[:, 0] == PlayerStatus.PLAYING))
+
+        hit = playing[actions[playing] == Action.HIT]
+        game.draw(hit, 0, [game.deal(hit)])
+        game.status[playing[actions[playing] == Action.STICK], 0] = PlayerStatus.STICK
+        self.__hit_low(hit)
+        done = playing[game.status[playing, 0] != PlayerStatus.PLAYING]
+        for j in range(1, game.n):
+            game.play_turn(self.others, done, j)
+        ended[done] = True
+
+        rewards = np.zeros(self.num_envs)
+        info = {}
+        if ended.any():
+            rewards[ended] = game.settlement(self.round_status)[ended, 0]
+            info = {"final_observation": self.observe(), "_final_observation": ended.copy(),
+                    "status": np.where(ended, self.round_status, GameStatus.PLAYING)}
+            if self.autoreset:
+                rows = np.flatnonzero(ended)
+                game.reset(rows)
+                self.__start(rows)
+            else:
+                self.round_status[ended] = GameStatus.PLAYING  # until reset
+        return self.observe(), rewards, ended, np.zeros(self.num_envs, dtype=bool), info
+
+
+_Env = gymnasium.Env if GYMNASIUM else object
+
+
+class BlackjackEnv(_Env):
+    """
+    One table, following the API of gymnasium.Env:
+        reset(seed) -> observation (3, ), info
+        step(action) -> observation, reward, terminated, truncated, info
+    """
+    metadata = {"render_modes": []}
+
+    def __init__(self, table: Table, others: AbstractModel = None, rng=None):
+        """
+        :param table: Table providing the deck of cards (m) and the number of players (n).
+        :type table: Table
+        :param others: model of the other gamblers of the table, TestModel by default.
+        :type others: AbstractModel
+        :param rng: random generator dealing the cards, or its seed, by default the one of the table.
+        :type rng: numpy.random.Generator
+        """
+        self.env = BlackjackVectorEnv(table, 1, others=others, autoreset=False, rng=rng)
+        if GYMNASIUM:
+            self.observation_space = self.env.single_observation_space
+            self.action_space = self.env.single_action_space
+
+    def reset(self, seed=None, options=None):
+        """
+        Deal a new round.
+        :param seed: seed of a new random generator dealing the cards, optional. With Gymnasium it seeds
+            self.np_random (gymnasium.Env.reset), which then deals the cards.
+        :return: observation of the agent, info
+        """
+        if GYMNASIUM:
+            super().reset(seed=seed)
+            if seed is not None:
+                self.env.game.rng = self.np_random
+                seed = None
+        observations, info = self.env.reset(seed=seed, options=options)
+        return observations[0], info
+
+    def step(self, action):
+        observations, rewards, terminated, truncated, info = self.env.step([action])
+        return (observations[0], float(rewards[0]), bool(terminated[0]), bool(truncated[0]),
+                {"status": GameStatus(info["status"][0])} if info else {})
@@ -0,0 +1,348 @@
+"""
+Compiled episode engine for tabular policies.
+
+The whole deal - hit - stick - settle loop of one episode runs in play_episode on plain arrays, which Numba compiles
+when it is installed (pip install numba). Without Numba the same functions would run as Python code, slower than
+Blackjack (element-wise access to NumPy arrays costs more than to Python objects), so CompiledBlackjack.play falls back
+to Blackjack.play; CompiledBlackjack.play_compiled still runs them, to check the engine anywhere. Cards and actions are drawn from the random buffers of the decks and of the model
+as Decks.deal and TabularModel.predict do, only the arrays of the buffers are passed to the compiled functions:
+CompiledBlackjack plays exactly the episodes of Blackjack with generators seeded alike.
+"""
+import numpy as np
+from environment.core import CARD_POINTS, ACE_CODES, GameStatus, PlayerStatus, Action
+from environment.blackjack import Blackjack, Table
+from model.abstract_model import AbstractModel, STATE_INDEX
+
+try:
+    from numba import njit
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+
+    def njit(*args, **kwargs):
+        # Leave the functions as they are
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# Modes of the decks: infinite, rebuilt every episode, or a shoe dealt until the cut card, see Decks.
+INFINITE, FRESH, SHOE = 0, 1, 2
+POINTS = np.array(CARD_POINTS, dtype=np.int64)
+MAX_DECISIONS = 21
+MAX_CARDS = 22  # cards in a hand: its raw sum is at most 21 before the last card
+# Plain integers for the compiled code
+HIT, STICK = int(Action.HIT), int(Action.STICK)
+GAME_END, GAME_PLAYING, GAME_NATURAL, GAME_DRAW = (int(GameStatus.END), int(GameStatus.PLAYING),
+                                                   int(GameStatus.NATURAL), int(GameStatus.DRAW))
+PLAYING, BUST, STUCK, NATURAL = (int(PlayerStatus.PLAYING), int(PlayerStatus.LOSE_BUST), int(PlayerStatus.STICK),
+                                 int(PlayerStatus.NATURAL))
+GAME_STATUSES = tuple(GameStatus)  # GameStatus of the status returned by play_episode
+# Columns of the hands array
+RAW, HAS_ACE, USABLE_ACE, PLAYER_POINTS, FIRST_CARD = range(5)
+
+
+@njit(cache=True)
+def uniform(random):
+    """
+    Next number of a RandomBuffer, given as (uniforms, position), position being an array of one element.
+    The generator stays out of the compiled code (unboxing it costs more than playing an episode): the buffer is
+    filled beforehand with the numbers an episode may need, see RandomBuffer.reserve.
+    """
+    uniforms, position = random
+    position[0] += 1
+    return uniforms[position[0] - 1]
+
+
+@njit(cache=True)
+def deal(cardset, deck, random, n):
+    """
+    Start dealing n cards, as Decks.deal does, and return the position of the first one in the shoe.
+    :param cardset: Decks.cardset, modified in place.
+    :param deck: (mode, size, cursor, start) of the decks, modified in place.
+    :param random: Decks.random, see uniform.
+    """
+    if deck[0] == SHOE:
+        if deck[2] + n > len(cardset):
+            # The shoe runs out in the middle of an episode, the cards in hand are not shuffled again.
+            reshuffle(cardset, deck, random)
+        deck[2] += n
+        return deck[2] - n
+    return -1
+
+
+@njit(cache=True)
+def reshuffle(cardset, deck, random):
+    """
+    Decks.reshuffle: shuffle the cards out of play and move the cards of the round to the front of the shoe.
+    """
+    uniforms, position = random
+    start, cursor = deck[3], deck[2]
+    in_play = cardset[start:cursor].copy()
+    rest = np.concatenate((cardset[:start], cardset[cursor:]))
+    order = np.argsort(uniforms[position[0]:position[0] + len(rest)])
+    position[0] += len(rest)
+    cardset[:len(in_play)] = in_play
+    cardset[len(in_play):] = rest[order]
+    deck[3], deck[2] = 0, len(in_play)
+
+
+@njit(cache=True)
+def next_card(cardset, deck, random, position):
+    """
+    Code of the next card dealt, position is the one returned by deal (and incremented) for a shoe.
+    """
+    if deck[0] == SHOE:
+        return cardset[position]
+    idx = int(uniform(random) * deck[1])
+    code = cardset[idx]
+    if deck[0] == FRESH:
+        # Remove the card dealt by moving the last remaining card to its place
+        deck[1] -= 1
+        cardset[idx] = cardset[deck[1]]
+    return code
+
+
+@njit(cache=True)
+def add_card(hands, j, code):
+    hands[j, RAW] += POINTS[code]
+    if code < ACE_CODES:
+        hands[j, HAS_ACE] = 1
+
+
+@njit(cache=True)
+def update_points(hands, j):
+    """
+    Update the usable ace and the points of player j once cards are added, as Player.draw_codes does.
+    """
+    if hands[j, HAS_ACE] == 1 and hands[j, USABLE_ACE] == 0 and hands[j, RAW] <= 11:
+        hands[j, USABLE_ACE] = 1
+    else:
+        hands[j, USABLE_ACE] = 0
+    hands[j, PLAYER_POINTS] = hands[j, RAW] + 10 * hands[j, USABLE_ACE]
+
+
+@njit(cache=True)
+def hit(cardset, deck, random, hands, j):
+    add_card(hands, j, next_card(cardset, deck, random, deal(cardset, deck, random, 1)))
+    update_points(hands, j)
+
+
+@njit(cache=True)
+def predict(Q, epsilon, random, state):
+    """
+    Epsilon-greedy action on the Q-table, drawing the same random numbers as TabularModel.predict.
+    """
+    if uniform(random) < epsilon:
+        return int(uniform(random) * 2)
+    if Q[state, 0] == Q[state, 1]:
+        return int(uniform(random) * 2)
+    return HIT if Q[state, 0] > Q[state, 1] else STICK
+
+
+@njit(cache=True)
+def settle(game_status, hands, status, rewards):
+    """
+    Rewards of the gamblers, as Blackjack.__settlement gives them.
+    """
+    n = len(status)
+    if game_status == GAME_DRAW:
+        rewards[:] = 0
+        return
+    if game_status == GAME_NATURAL:
+        for j in range(n - 1):
+            rewards[j] = 1.5 if status[j] == NATURAL else -1
+        return
+
+    points = np.where(hands[:, PLAYER_POINTS] > 21, 0, hands[:, PLAYER_POINTS])
+    if status[n - 1] == BUST:
+        rewards[:] = 0
+        for j in range(n - 1):
+            if status[j] == STUCK:  # There is still any gambler not getting busted
+                for k in range(n - 1):
+                    rewards[k] = 1 if points[k] != 0 else -1
+                break
+        return
+    dealer_point = points[n - 1]
+    max_gambler_point = points[:n - 1].max()
+    for j in range(n - 1):
+        if max_gambler_point < dealer_point:
+            rewards[j] = -1
+        elif max_gambler_point == dealer_point:
+            rewards[j] = 0
+        else:
+            rewards[j] = 1 if points[j] >= dealer_point else -1
+
+
+@njit(cache=True)
+def play_episode(cardset, deck, deck_uniforms, n, Q, epsilon, policy_uniforms, positions, state_index, observations,
+                 actions, lengths, rewards):
+    """
+    Play one episode of n players, the last one being the dealer, on decks prepared for a new round.
+    Only arrays and scalars are passed: Numba checks the types of tuples in Python at every call.
+    :param cardset: Decks.cardset, modified in place.
+    :param deck: (mode, size, cursor, start) of the decks, modified in place.
+    :param deck_uniforms: uniforms of Decks.random, see uniform.
+    :param Q: Q-table of the gamblers' policy, shape (200, 2)
+    :param epsilon: exploration rate of the gamblers
+    :param policy_uniforms: uniforms of the random buffer of the gamblers' policy.
+    :param positions: positions of the two random buffers, shape (2, 1), modified in place.
+    :param state_index: STATE_INDEX
+    :param observations: filled with the observations of every gambler, shape (n-1, MAX_DECISIONS, 3)
+    :param actions: filled with the actions of every gambler, shape (n-1, MAX_DECISIONS)
+    :param lengths: filled with the number of decisions of every gambler, shape (n-1, )
+    :param rewards: filled with the reward of every gambler, shape (n-1, )
+    :return: Game ending status
+    """
+    deck_random, policy_random = (deck_uniforms, positions[0]), (policy_uniforms, positions[1])
+    hands = np.zeros((n, 5), dtype=np.int64)
+    status = np.full(n, PLAYING, dtype=np.int64)
+    natural = 0
+    for j in range(n):
+        position = deal(cardset, deck, deck_random, 2)
+        for k in range(2):
+            code = next_card(cardset, deck, deck_random, position + k)
+            if k == 0:
+                hands[j, FIRST_CARD] = code
+            add_card(hands, j, code)
+        update_points(hands, j)
+        if hands[j, PLAYER_POINTS] + 10 == 21 and hands[j, USABLE_ACE] == 1:
+            status[j] = NATURAL
+            if j < n - 1:
+                natural = 1
+    dealer_show = POINTS[hands[n - 1, FIRST_CARD]]
+    lengths[:] = 0
+
+    game_status = GAME_PLAYING
+    if natural == 1:
+        game_status = GAME_DRAW if status[n - 1] == NATURAL else GAME_NATURAL
+    elif status[n - 1] == NATURAL:
+        game_status = GAME_NATURAL
+    if game_status != GAME_PLAYING:
+        # Settle, then record one decision of every gambler
+        settle(game_status, hands, status, rewards)
+        for j in range(n - 1):
+            observations[j, 0, 0] = hands[j, PLAYER_POINTS]
+            observations[j, 0, 1] = dealer_show
+            observations[j, 0, 2] = hands[j, USABLE_ACE]
+            state = state_index[hands[j, PLAYER_POINTS], dealer_show, hands[j, USABLE_ACE]]
+            actions[j, 0] = predict(Q, epsilon, policy_random, state)
+            lengths[j] = 1
+        return game_status
+
+    for j in range(n):
+        while True:
+            while hands[j, PLAYER_POINTS] < 12:  # if sum of player is less than 12, always hit
+                hit(cardset, deck, deck_random, hands, j)
+
+            if j == n - 1:
+                action = STICK if hands[j, PLAYER_POINTS] >= 17 else HIT  # DealerPolicy
+            else:
+                state = state_index[hands[j, PLAYER_POINTS], dealer_show, hands[j, USABLE_ACE]]
+                action = predict(Q, epsilon, policy_random, state)
+                t = lengths[j]
+                observations[j, t, 0] = hands[j, PLAYER_POINTS]
+                observations[j, t, 1] = dealer_show
+                observations[j, t, 2] = hands[j, USABLE_ACE]
+                actions[j, t] = action
+                lengths[j] += 1
+
+            if action == STICK:
+                status[j] = STUCK
+                break
+            hit(cardset, deck, deck_random, hands, j)
+            if hands[j, RAW] > 21:
+                status[j] = BUST
+                break
+
+    settle(GAME_END, hands, status, rewards)
+    return GAME_END
+
+
+class CompiledBlackjack(Blackjack):
+    """
+    Blackjack game playing every episode in play_episode, for tabular models (models with a Q-table, an
+    exploration rate and a random buffer, as TabularModel), or their frozen policy once frozen. Other models, and every
+    model without Numba, are played by Blackjack.play.
+    The episodes are not logged, and the players on the table are not updated by the compiled engine.
+    """
+    def __init__(self, table: Table, recorder=None):
+        """
+        :param table: the table to play on.
+        :type table: Table
+        :param recorder: an ExperienceRecorder watching every episode played, optional.
+        :type recorder: ExperienceRecorder
+        """
+        super().__init__(table, recorder=recorder, trace=False)
+        self.observations = np.zeros((table.n - 1, MAX_DECISIONS, 3), dtype=np.int64)
+        self.actions_taken = np.zeros((table.n - 1, MAX_DECISIONS), dtype=np.int64)
+        self.lengths = np.zeros(table.n - 1, dtype=np.int64)
+        self.rewards = np.zeros(table.n - 1)
+        self.deck = np.zeros(4, dtype=np.int64)  # mode, size, cursor, start of the round
+        self.positions = np.zeros((2, 1), dtype=np.int64)  # positions of the random buffers of the decks and policy
+        self.frozen = (None, None)  # frozen policy of the last model played, and its one-hot Q-table
+
+    def play(self, model: AbstractModel):
+        """
+        Play one round of the Blackjack game.
+        :param model: The model for gambler's action.
+        :type model: AbstractModel
+        :return: Game ending status, rewards, player_trajectorys
+        :rtype: GameStatus, numpy.array, List[List[(player_sum, dealer_showing, usable_ace)]]
+        """
+        if not NUMBA or getattr(model, "Q", None) is None or not hasattr(model, "random"):
+            return super().play(model)
+        return self.play_compiled(model)
+
+    def play_compiled(self, model: AbstractModel):
+        """
+        Play one round of a tabular model in play_episode, compiled or not: without Numba it plays the same episodes
+        as with it, only slower than Blackjack.play.
+        :param model: a model with a Q-table, an exploration rate and a random buffer.
+        :type model: AbstractModel
+        :return: Game ending status, rewards, player_trajectorys
+        """
+        Q = model.Q
+        epsilon = model.exploration_rate
+        if model.frozen is not None:
+            # A frozen model serves its policy alone, without exploration: the Q-table of its actions (no tie)
+            if self.frozen[0] is not model.frozen:
+                self.frozen = (model.frozen, np.eye(2)[model.frozen.reshape(-1)])
+            Q, epsilon = self.frozen[1], 0.0
+
+        self.episode += 1
+        decks = self.table.decks
+        decks.next_round()
+        n = self.table.n
+        deck_random, policy = decks.random, model.random
+        # Numbers an episode may draw at most: one per card (a hand holds at most MAX_CARDS cards) or the shuffle of
+        # the shoe when it runs out, and two per decision
+        if decks.m == 0:
+            mode = INFINITE
+            self.deck[:] = (mode, decks.size, 0, 0)
+            deck_random.reserve(MAX_CARDS * n)
+        elif decks.penetration is None:
+            mode = FRESH
+            self.deck[:] = (mode, decks.size, 0, 0)
+            deck_random.reserve(MAX_CARDS * n)
+        else:
+            mode = SHOE
+            self.deck[:] = (mode, decks.size, decks.cursor, decks.start)
+            deck_random.reserve(len(decks.cardset))
+        policy.reserve(2 * MAX_DECISIONS * (n - 1))
+        positions = self.positions
+        positions[:, 0] = deck_random.position, policy.position
+        status = play_episode(decks.cardset, self.deck, deck_random.uniforms, n, Q.reshape(-1, 2),
+                              epsilon, policy.uniforms, positions, STATE_INDEX,
+                              self.observations, self.actions_taken, self.lengths, self.rewards)
+        decks.size = int(self.deck[1])
+        if mode == SHOE:
+            decks.cursor, decks.start = int(self.deck[2]), int(self.deck[3])
+        deck_random.position, policy.position = int(positions[0, 0]), int(positions[1, 0])
+
+        reward = self.rewards.reshape((n - 1, 1)).copy()
+        player_trajectory = [list(zip(map(tuple, self.observations[j, :length].tolist()),
+                                      self.actions_taken[j, :length].tolist()))
+                             for j, length in enumerate(self.lengths.tolist())]
+        if self.recorder is not None:
+            self.recorder.watch(reward, player_trajectory)
+        return GAME_STATUSES[status], reward, player_trajectory
@@ -1,32 +1,153 @@
+import os
+import glob
+import tempfile
 import numpy as np
 import pandas as pd
 from typing import Union, List
-from environment.core import Gambler
+from environment.core import Gambler, Action, EXPERIENCE_DTYPE
 
 
 class ExperienceRecorder(object):
     """
     Observe and record Blackjack game episodes.
-    obs: dict of gamblers' playing history, e.g.
-        {
-            0: [(15, 4, 0), (20, 4, 0)],  #
-            1: [(), (), ()],
-            2: []
-        }
-    val: list of gamblers' rewards, e.g.
-        [-1, -1, -1]  # assuming dealer wins
+    Episodes are stored in an append-only directory of chunk files (000000.npy, 000001.npy, ...), each of them an
+    array of EXPERIENCE_DTYPE records, one record per decision of a gambler, e.g.
+        (episode, player, player_sum, dealer_show, usable_ace, action, reward)
+        (0,       0,      15,         4,           0,          HIT,    -1)
+        (0,       0,      20,         4,           0,          STICK,  -1)
+        (0,       1,      18,         4,           0,          STICK,  -1)  # assuming dealer wins
+    Chunks are read back memory-mapped, so a large corpus can be replayed at disk speed.
     """
-    def __init__(self):
+    def __init__(self, directory: str = None, chunk_size=65536):
+        """
+        :param directory: where the chunk files are stored, episodes already there are kept. By default a new
+            temporary directory, which is left on disk (see self.directory).
+        :type directory: str
+        :param chunk_size: number of records buffered before writing a chunk file.
+        :type chunk_size: int
+        """
+        self.directory = tempfile.mkdtemp(prefix="experience_") if directory is None else directory
+        self.chunk_size = chunk_size
+        os.makedirs(self.directory, exist_ok=True)
         self.__reset()
 
     def __reset(self):
-        self.obs = {}
-        self.val = None
-        # self.N = 0
+        self.buffer = np.empty(self.chunk_size, dtype=EXPERIENCE_DTYPE)
+        self.k = 0  # number of records in buffer
+        chunks = self.chunks()
+        self.n_chunks = len(chunks)
+        self.episodes = int(np.load(chunks[-1], mmap_mode="r")["episode"][-1]) + 1 if chunks else 0
 
     def reset(self):
+        """
+        Remove all the recorded episodes.
+        """
+        for chunk in self.chunks():
+            os.remove(chunk)
         self.__reset()
 
-    def watch(self, gamblers: List[Gambler]) -> None:
-        pass
+    def chunks(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "[0-9]" * 6 + ".npy")))
 
+    def watch(self, rewards, player_trajectory) -> None:
+        """
+        Record one episode, as returned by Blackjack.play. Call flush() once done to write the last records.
+        """
+        for j, trajectory in enumerate(player_trajectory):
+            for obs, action in trajectory:
+                self.buffer[self.k] = (self.episodes, j, obs[0], obs[1], obs[2], action, np.ravel(rewards)[j])
+                self.k += 1
+                if self.k == self.chunk_size:
+                    self.flush()
+        self.episodes += 1
+
+    def record(self, game, model, episodes) -> None:
+        """
+        Play and record episodes with game.stream.
+        """
+        for chunk in game.stream(model, episodes, chunk_size=self.chunk_size):
+            chunk["episode"] += self.episodes
+            self.write(chunk)
+        self.episodes += episodes
+        self.flush()
+
+    def write(self, records) -> None:
+        """
+        Append records, their episode ids are kept as is.
+        """
+        while len(records):
+            size = min(self.chunk_size - self.k, len(records))
+            self.buffer[self.k:self.k + size] = records[:size]
+            records = records[size:]
+            self.k += size
+            if self.k == self.chunk_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered records to a new chunk file.
+        """
+        if self.k:
+            np.save(os.path.join(self.directory, "{:06d}.npy".format(self.n_chunks)), self.buffer[:self.k])
+            self.n_chunks += 1
+            self.k = 0
+
+    def read(self, mmap=True):
+        """
+        Iterate over the recorded chunks (flushed ones only).
+        :param mmap: memory-map the chunk files instead of loading them.
+        :type mmap: bool
+        """
+        for chunk in self.chunks():
+            yield np.load(chunk, mmap_mode="r" if mmap else None)
+
+    def replay(self):
+        """
+        Iterate over the recorded episodes, in the format of Blackjack.play: rewards, player_trajectory.
+        """
+        rest = np.empty(0, dtype=EXPERIENCE_DTYPE)
+        for chunk in self.read():
+            records = np.concatenate([rest, chunk])
+            # The last episode of a chunk may continue in the next one
+            starts = np.flatnonzero(np.diff(records["episode"])) + 1
+            for episode in np.split(records, starts)[:-1]:
+                yield self.__episode(episode)
+            rest = records[starts[-1]:] if len(starts) else records
+        if len(rest):
+            yield self.__episode(rest)
+
+    @staticmethod
+    def __episode(records):
+        n_gamblers = int(records["player"].max()) + 1
+        rewards = np.zeros((n_gamblers, 1))
+        player_trajectory = [[] for j in range(n_gamblers)]
+        for episode, j, player_sum, dealer_show, usable_ace, action, reward in records.tolist():
+            player_trajectory[j].append(((player_sum, dealer_show, usable_ace), action))
+            rewards[j] = reward
+        return rewards, player_trajectory
+
+
+class ExperienceReplay(object):
+    """
+    A game replaying recorded episodes instead of playing, e.g. to train models on a recorded corpus:
+        model = MonteCarloControl(ExperienceReplay(recorder)); model.train(...)
+    The model's actions are ignored, and the recorded episodes are replayed again from the start once exhausted.
+    """
+    actions = [Action.HIT, Action.STICK]
+
+    def __init__(self, recorder: ExperienceRecorder):
+        self.recorder = recorder
+        self.table = None
+        self.__episodes = iter(())
+
+    def play(self, model):
+        """
+        :return: Game ending status (not recorded, None), rewards, player_trajectorys
+        """
+        episode = next(self.__episodes, None)
+        if episode is None:
+            self.__episodes = self.recorder.replay()
+            episode = next(self.__episodes, None)
+            if episode is None:
+                raise Exception("No episode recorded in {}!".format(self.recorder.directory))
+        return (None, ) + episode
@@ -1,3 +1,4 @@
+import os
 from itertools import product
 import pytest
 
@@ -13,6 +14,9 @@ from model.QLearning import QLearning
 
 name_record = "./record/npz/{}_m{}_n{}_e{:.0e}.npz"
 name_figure = "./record/{}_m{}_n{}_e{:.0e}.png"
+# Training state, saved every 10% of the episodes: a run interrupted midway resumes from it when started again.
+# It is removed once the model is saved, so that a finished run is trained again the next time.
+name_checkpoint = "./record/npz/{}_m{}_n{}_e{:.0e}.checkpoint.npz"
 
 m = [6, 3, 1]
 n = [3, 4, 6]
@@ -29,7 +33,7 @@ models = {
 @pytest.fixture
 def game(request):  # Does the parameter of fixture function must be named request?
     table = blackjack.Table(*request.param)
-    game = blackjack.Blackjack(table=table)
+    game = blackjack.Blackjack(table=table, trace=False)
     return game
 
 
@@ -38,8 +42,11 @@ def game(request):  # Does the parameter of fixture function must be named reque
 def test_q1(game, model):
     logger.disable("environment.blackjack")
     policy = models[model](game)
-    policy.train(episodes=episodes, exploration_rate=1.0, exploration_decay=1-1e-5, gamma=1.0)
+    checkpoint = name_checkpoint.format(model, game.table.m, game.table.n, episodes)
+    policy.train(episodes=episodes, checkpoint=checkpoint, resume=True,
+                 exploration_rate=1.0, exploration_decay=1-1e-5, gamma=1.0)
     policy.save(name_record.format(model, game.table.m, game.table.n, episodes))
+    os.remove(checkpoint)
     model_visualization.draw_policy(policy.Q, filename=name_figure.format(model, game.table.m, game.table.n, episodes))
 
 
@@ -48,7 +55,10 @@ def test_q1(game, model):
 def test_combinations(game, model):
     logger.disable("environment.blackjack")
     policy = models[model](game)
-    policy.train(episodes=episodes, exploration_rate=1, exploration_decay=1-1e-5)  # , learning_rate = 0.5)
+    checkpoint = name_checkpoint.format(model, game.table.m, game.table.n, episodes)
+    policy.train(episodes=episodes, checkpoint=checkpoint, resume=True,
+                 exploration_rate=1, exploration_decay=1-1e-5)  # , learning_rate = 0.5)
     policy.save(name_record.format(model, game.table.m, game.table.n, episodes))
+    os.remove(checkpoint)
     model_visualization.draw_policy(policy.Q, filename=name_figure.format(model, game.table.m, game.table.n, episodes))
 
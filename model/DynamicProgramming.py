@@ -0,0 +1,93 @@
+from functools import lru_cache
+import numpy as np
+from environment import core, blackjack
+from environment.dealer import CARD_PROBABILITY, DEALER_OUTCOMES, draw, points, dealer_outcome, dealer_distribution
+from model.abstract_model import AbstractModel, q_obs_index, q_state_index
+from loguru import logger
+
+
+class DynamicProgramming(AbstractModel):
+    """
+    Exact optimal action value function of the gambler when m = 0 (infinite deck) and n = 2,
+    computed by enumerating the card probabilities instead of sampling episodes.
+    """
+
+    def __init__(self, game, **kwargs):
+        super().__init__(game)
+        self.exploration_rate = 0
+        self.rng = kwargs.get("rng")  # tie-breaking, see core.default_rng
+        self.Q = np.zeros((10, 10, 2, 2))  # PlayerSum, DealerShow, UsableAce, Action
+
+    def save(self, filename):
+        np.savez(filename, **{"Q": self.Q})
+
+    def load(self, filename):
+        loader = np.load(file=filename)
+        self.Q = loader.get("Q")
+
+    def train(self, stop_at_convergence=True, **kwargs):
+        """
+        Solve the Bellman optimality equation, the episode terminates when the gambler sticks or goes bust.
+        """
+        if self.game is not None:
+            assert self.game.table.m == 0 and self.game.table.n == 2, \
+                "Exact solution is only available for infinite deck of cards and 2 players!"
+        self.gamma = kwargs.get("gamma", 1)  # $\gamma$
+
+        self.expected_return = 0  # Expected reward of one episode following the optimal policy
+        for show in range(1, 11):
+            self.expected_return += CARD_PROBABILITY[show - 1] * self.__solve(show, dealer_distribution(show))
+        self.update_greedy()
+        logger.info("Optimal policy solved, expected return {:.5f}.".format(self.expected_return))
+
+    def __solve(self, show, dealer):
+        # Reward of the gambler for each final dealer points, given gambler's points (0 if busted)
+        def reward(gambler_points):
+            if gambler_points == 0:  # Everyone goes bust gives 0, otherwise dealer wins
+                return -dealer[:-1].sum()
+            return sum(p * (1 if d == 0 or gambler_points > d else 0 if gambler_points == d else -1)
+                       for d, p in zip(DEALER_OUTCOMES, dealer))
+
+        @lru_cache(maxsize=None)
+        def value_after_draw(state):
+            # The gambler always hits if sum is less than 12
+            if state[0] > 21:
+                return reward(0)
+            if points(state) < 12:
+                return sum(p * value_after_draw(draw(state, (v,))) for v, p in enumerate(CARD_PROBABILITY, 1))
+            return max(action_values(state))
+
+        @lru_cache(maxsize=None)
+        def action_values(state):
+            hit = 0
+            for v, p in enumerate(CARD_PROBABILITY, 1):
+                next_state = draw(state, (v,))
+                hit += p * (reward(0) if next_state[0] > 21 else self.gamma * value_after_draw(next_state))
+            return hit, reward(points(state))
+
+        # For decisions (sum >= 12) the usable ace tells the whole hand: raw = sum - 10 when usable,
+        # and an ace without being usable can not be used any more.
+        for player_sum in range(12, 22):
+            for usable in (0, 1):
+                state = (player_sum - 10 * usable, bool(usable), bool(usable))
+                self._Q[q_obs_index((player_sum, show, usable))] = action_values(state)
+        # Expected return given the face up card, over the first two cards of the gambler
+        return sum(p1 * p2 * value_after_draw(draw((0, False, False), (v1, v2)))
+                   for v1, p1 in enumerate(CARD_PROBABILITY, 1)
+                   for v2, p2 in enumerate(CARD_PROBABILITY, 1))
+
+    def q(self, obs: tuple):
+        return self.Q.reshape(-1, 2)[q_state_index(obs)]
+
+    def predict(self, state: tuple):
+        return self.greedy_action(state)
+
+
+if __name__ == '__main__':
+    table = blackjack.Table(m=0, n=2)  # Infinity deck of cards and 2 players
+    game = blackjack.Blackjack(table=table)
+    model = DynamicProgramming(game=game)
+    model.train()
+    print(model.Q[:, :, 0, 0])
+    print(model.Q[:, :, 0, 1])
+    model.save("DP_m0_n2.npz")
@@ -11,8 +11,9 @@ from loguru import logger
 from tqdm import tqdm
 
 from environment import blackjack
-from environment.core import GameStatus
-from model.abstract_model import TestModel
+from environment.batch_blackjack import BatchBlackjack
+from environment.core import GameStatus, default_rng
+from model.abstract_model import TestModel, q_state_index, q_state_indices
 
 logger.disable("environment.blackjack")
 
@@ -67,52 +68,176 @@ def indices_merged_arr_generic(arr, arr_pos="last"):
     return out
 
 
-def single_play(game, model, n=0):
+def single_play(game, model, seed=None):
     logger.disable("environment.blackjack")
+    if seed is not None:
+        # Every episode is played with its own stream, instead of the state copied with the game and the model
+        game.rng = np.random.default_rng(seed)
+        model.rng = game.rng
     status, reward, player_trajectory = game.play(model)
     if status in (GameStatus.END, GameStatus.DRAW, GameStatus.NATURAL):
         return status, reward, player_trajectory
 
 
-def parallel_play(game, model, R=1000, nprocs=0):
+def parallel_play(game, model, R=1000, nprocs=0, seed=None):
     if nprocs == 0:
         num_cores = multiprocessing.cpu_count()  # 8
     else:
         num_cores = min(multiprocessing.cpu_count(), abs(nprocs))
     f = partial(single_play, game, model)
+    seeds = np.random.SeedSequence(seed).spawn(R)
     with tqdm_joblib(tqdm(desc="Simulation", total=R)) as progress_bar:
-        res = Parallel(n_jobs=num_cores)(delayed(f)(i) for i in range(R))
+        res = Parallel(n_jobs=num_cores)(delayed(f)(seeds[i]) for i in range(R))
     return res
 
+class MonteCarloEvaluator(object):
+    """
+    Monte Carlo prediction of the state value function of a fixed policy: V(s) is the average return following the
+    visits of s. Returns are folded episode by episode into per-state sums and counts, indexed by the flat state index
+    of the Q-tables (see q_state_index, observations below 12 wrap around as they do in the Q-tables), so the
+    episodes are never stored, and parallel workers only send back their partial sums.
+    The reward is given at the end of an episode, the return of the t-th of T decisions is gamma^(T-1-t) * reward.
+    """
+    def __init__(self, first_visit=False, gamma=1.0):
+        """
+        :param first_visit: only count the first visit of a state in the trajectory of a gambler, every visit otherwise.
+        :type first_visit: bool
+        :param gamma: discount factor.
+        :type gamma: float
+        """
+        self.first_visit = first_visit
+        self.gamma = gamma
+        self.reset()
+
+    def reset(self):
+        self.returns = np.zeros(10 * 10 * 2)  # sum of the returns of every state
+        self.counts = np.zeros(len(self.returns), dtype=np.int64)  # number of visits of every state
+        self.episodes = 0
+
+    @property
+    def V(self):
+        """
+        Estimated state value function, of shape (10, 10, 2) as the Q-tables without the action, NaN if not visited.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.returns / self.counts).reshape((10, 10, 2))
+
+    def observe(self, rewards, player_trajectory):
+        """
+        Add one episode, as returned by Blackjack.play.
+        """
+        for j, trajectory in enumerate(player_trajectory):
+            reward = float(np.ravel(rewards)[j])
+            seen = set()
+            for t, (obs, action) in enumerate(trajectory):
+                state = q_state_index(obs)
+                if self.first_visit:
+                    if state in seen:
+                        continue
+                    seen.add(state)
+                self.returns[state] += self.gamma ** (len(trajectory) - 1 - t) * reward
+                self.counts[state] += 1
+        self.episodes += 1
+
+    def observe_batch(self, rewards, observations, lengths):
+        """
+        Add a batch of episodes, as returned by BatchBlackjack.play_batch.
+        :param rewards: shape (batch_size, n-1)
+        :param observations: shape (batch_size, n-1, max_decisions, 3)
+        :param lengths: shape (batch_size, n-1)
+        """
+        steps = np.arange(observations.shape[2])
+        played = steps < lengths[..., None]
+        states = q_state_indices(observations[played])
+        returns = np.broadcast_to(rewards[..., None], played.shape)[played]
+        if self.gamma != 1:
+            returns = returns * np.power(self.gamma, (lengths[..., None] - 1 - steps)[played])
+        if self.first_visit:
+            # Decisions are ordered by trajectory then by time, keep the first one of every state of a trajectory
+            trajectory = np.broadcast_to(np.arange(lengths.size).reshape(lengths.shape)[..., None], played.shape)
+            _, first = np.unique(trajectory[played] * len(self.returns) + states, return_index=True)
+            states, returns = states[first], returns[first]
+        self.returns += np.bincount(states, weights=returns, minlength=len(self.returns))
+        self.counts += np.bincount(states, minlength=len(self.counts))
+        self.episodes += len(rewards)
+
+    def merge(self, returns, counts, episodes):
+        """
+        Add the partial sums of another evaluator.
+        """
+        self.returns += returns
+        self.counts += counts
+        self.episodes += episodes
+
+    def play(self, game, model, episodes, seed=None):
+        """
+        Play and add episodes in this process, batch by batch if the game plays batches (BatchBlackjack).
+        :param seed: seed of the random generator of the game and of the model, if given.
+        :type seed: Union[int, numpy.random.SeedSequence]
+        """
+        if seed is not None:
+            game.rng = default_rng(seed)
+            if hasattr(model, "random"):
+                model.rng = game.rng
+        if hasattr(game, "play_batch"):
+            played = 0
+            while played < episodes:
+                _, rewards, (observations, actions, lengths) = game.play_batch(model)
+                size = min(len(rewards), episodes - played)
+                self.observe_batch(rewards[:size], observations[:size], lengths[:size])
+                played += size
+        else:
+            for i in range(episodes):
+                self.observe(*game.play(model)[1:])
+        return self
+
+    def evaluate(self, game, model, episodes, nprocs=0, seed=None, task_size=10000):
+        """
+        Play and add episodes over parallel workers. Episodes are split in tasks of task_size episodes, each of them
+        played with a stream spawned from seed, so the result does not depend on the number of workers.
+        :param nprocs: number of worker processes, 0 for all the cores.
+        :type nprocs: int
+        :return: self
+        """
+        num_cores = multiprocessing.cpu_count() if nprocs == 0 else min(multiprocessing.cpu_count(), abs(nprocs))
+        sizes = [min(task_size, episodes - start) for start in range(0, episodes, task_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        f = partial(_partial_evaluation, game, model, self.first_visit, self.gamma)
+        with tqdm_joblib(tqdm(desc="Simulation", total=len(sizes))) as progress_bar:
+            partials = Parallel(n_jobs=num_cores)(delayed(f)(size, seed) for size, seed in zip(sizes, seeds))
+        for partial_sums in partials:
+            self.merge(*partial_sums)
+        return self
+
+    def to_frame(self):
+        """
+        The state value function as a table of PlayerSum, DealerShow, UsableAce and Value, the layout of the CSV files.
+        """
+        V_df = pd.DataFrame(indices_merged_arr_generic(self.V),
+                            columns=["PlayerSum", "DealerShow", "UsableAce", "Value"])
+        V_df.PlayerSum += 12
+        V_df.DealerShow += 1
+        return V_df
+
+
+def _partial_evaluation(game, model, first_visit, gamma, episodes, seed):
+    evaluator = MonteCarloEvaluator(first_visit, gamma).play(game, model, episodes, seed)
+    return evaluator.returns, evaluator.counts, evaluator.episodes
+
+
 if __name__ == '__main__':
     # Generate episodes
     logger.disable("environment.blackjack")
     R = 50000
-    vf = np.zeros(shape=(10, 10, 2))
 
     table = blackjack.Table(m=0, n=2)  # Infinity deck of cards and 2 players
-    game = blackjack.Blackjack(table=table)
+    game = BatchBlackjack(table=table)
     model = TestModel()
-    # V = dict()
-
-    states = np.zeros((10, 10, 2))
-    states_count = np.zeros((10, 10, 2))
-
-    res = parallel_play(game, model, R, nprocs=6)
-    print(res)
-
-    for episode in res:
-        for reward, player_trajectory in zip(episode[1], episode[2]):
-             for obs, _ in player_trajectory:
-                 obs_index = tuple(np.array(obs) - np.array([12, 1, 0]))
-                 states[obs_index] += reward
-                 states_count[obs_index] += 1
-
-    V = states / states_count
 
-    V_df = pd.DataFrame(indices_merged_arr_generic(V), columns=["PlayerSum", "DealerShow", "UsableAce", "Value"])
-    V_df.PlayerSum += 12
-    V_df.DealerShow += 1
+    # Every worker folds its episodes into per-state sums, only those are sent back and added up.
+    evaluator = MonteCarloEvaluator(first_visit=False)
+    evaluator.evaluate(game, model, R)
+    V_df = evaluator.to_frame()
 
     print(V_df.Value.max())
 
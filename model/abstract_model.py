@@ -1,20 +1,221 @@
+import contextlib
+import json
+import os
+import sys
+from multiprocessing import shared_memory
 import numpy as np
 from abc import ABC, abstractmethod
 from environment import core
+from model.convergence import ConvergenceMonitor
+from loguru import logger
+
+
+# Every observation (PlayerSum, DealerShow, UsableAce) a gambler can make, and its index in a Q-table.
+# Sums below 12 (only observed when the game ends at dealing) wrap around as negative indices do.
+_Q_OBS_INDEX = {(player_sum, dealer_show, usable_ace): (player_sum - 12, dealer_show - 1, usable_ace)
+                for player_sum in range(2, 22) for dealer_show in range(1, 11) for usable_ace in range(2)}
+# Flat index of every observation in a Q-table reshaped to (200, 2): STATE_INDEX[player_sum, dealer_show, usable_ace],
+# -1 for impossible observations.
+STATE_INDEX = np.full((22, 11, 2), -1, dtype=np.int64)
+_STATE_INDEX = {}
+for _obs, _index in _Q_OBS_INDEX.items():
+    STATE_INDEX[_obs] = np.ravel_multi_index(_index, (10, 10, 2), mode="wrap")
+    _STATE_INDEX[_obs] = int(STATE_INDEX[_obs])
+# Entry of a greedy table (see AbstractModel.update_greedy) for a state whose two actions tie
+TIE = -1
+
+
+def _read_only(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
 
 
 def q_obs_index(obs):
     # Return the index of given observation in a Q-table.
-    return tuple(np.array(obs) - np.array([12, 1, 0]))
+    try:
+        return _Q_OBS_INDEX[obs]
+    except (KeyError, TypeError):
+        return tuple(np.array(obs) - np.array([12, 1, 0]))
+
+
+def q_state_index(obs):
+    # Return the flat index of given observation in a Q-table reshaped to (200, 2).
+    try:
+        return _STATE_INDEX[obs]
+    except (KeyError, TypeError):
+        return int(STATE_INDEX[tuple(obs)])
+
+
+def q_state_indices(obs):
+    """
+    Flat indices of a batch of observations.
+    :param obs: observations, array of shape (..., 3)
+    :type obs: numpy.array
+    :rtype: numpy.array of shape (...)
+    """
+    return STATE_INDEX[obs[..., 0], obs[..., 1], obs[..., 2]]
+
+
+
+def transitions(rewards, observations, actions, lengths):
+    """
+    Flatten the trajectories of a batch of episodes, as returned by BatchBlackjack.play_batch, into one transition per
+    decision. Decisions of a gambler are consecutive, and every transition carries the gambler's final reward.
+    :param rewards: rewards of each gambler, shape (batch_size, n-1)
+    :param observations: shape (batch_size, n-1, max_decisions, 3)
+    :param actions: shape (batch_size, n-1, max_decisions)
+    :param lengths: number of decisions of each gambler, shape (batch_size, n-1)
+    :return: states, actions, rewards, next_states and next_actions, -1 as next state and action of the last decision.
+    :rtype: (numpy.array, numpy.array, numpy.array, numpy.array, numpy.array)
+    """
+    steps = np.arange(actions.shape[-1])
+    played = steps < lengths[..., None]
+    states = q_state_indices(observations[played])
+    actions = actions[played]
+    rewards = np.broadcast_to(rewards[..., None], played.shape)[played]
+    last = (steps == lengths[..., None] - 1)[played]
+    next_states = np.where(last, -1, np.roll(states, -1))
+    next_actions = np.where(last, -1, np.roll(actions, -1))
+    return states, actions, rewards, next_states, next_actions
+
+
+def _flatten(state, prefix=""):
+    # Nested dictionaries of a checkpoint as (key, value) pairs, keys of the levels are joined by "."
+    for key, value in state.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, prefix + key + ".")
+        else:
+            yield prefix + key, value
+
+
+def _unflatten(arrays):
+    state = {}
+    for key, value in arrays.items():
+        *path, name = key.split(".")
+        node = state
+        for level in path:
+            node = node.setdefault(level, {})
+        node[name] = value
+    return state
 
 
 class AbstractModel(ABC):
     check_convergence_every = 5
     discount = 1
+    shared_arrays = ()  # Names of the array attributes that can be placed in shared memory
+    greedy = None  # Greedy action of every state of the Q-table, see update_greedy
+    frozen = None  # Policy served alone in inference mode, see freeze
 
     def __init__(self, game):
         self.game = game
-        pass
+        self._shared = {}  # name of array: SharedMemory segment holding it
+        self._owner = False
+
+    @property
+    def rng(self):
+        return self.random.rng
+
+    @rng.setter
+    def rng(self, rng):
+        # Models draw their random numbers in blocks, see core.RandomBuffer
+        self.random = core.RandomBuffer(rng)
+
+    @property
+    def Q(self):
+        # Q-table, None for models without any. A read-only view, so that the greedy table never goes stale:
+        # assigning it refreshes the greedy table, and writes in place go through editing_q().
+        return self.__dict__.get("_Q_view")
+
+    @Q.setter
+    def Q(self, Q):
+        self.__dict__["Q"] = Q
+        self.__dict__["_Q_view"] = None if Q is None else _read_only(Q)
+        if Q is not None:
+            self.update_greedy()
+
+    @property
+    def _Q(self):
+        # Writable Q-table, for the learners, which refresh the greedy table of the states they update
+        return self.__dict__["Q"]
+
+    @contextlib.contextmanager
+    def editing_q(self):
+        """
+        Write into the Q-table in place, the whole greedy table is refreshed at the end of the block:
+            with model.editing_q() as Q:
+                Q[0, 0, 0] = (1, 0)
+        """
+        try:
+            yield self._Q
+        finally:
+            self.update_greedy()
+
+    @property
+    def shared(self):
+        return bool(self._shared)
+
+    def share(self):
+        """
+        Move the arrays listed in shared_arrays into shared memory segments owned by this model.
+        A pickled copy of the model (e.g. sent to a worker process) attaches to the same segments instead of
+        copying the arrays, so it reads and writes live values. The owner has to release() the segments,
+        or use the model as a context manager: `with model.share(): ...`.
+        """
+        if self.shared:
+            return self
+        for name in self.shared_arrays:
+            array = getattr(self, name)
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+            view[...] = array
+            setattr(self, name, view)
+            self._shared[name] = segment
+        self._owner = True
+        return self
+
+    def release(self):
+        """
+        Copy the shared arrays back to private memory and close the segments, the owner also destroys them.
+        """
+        for name, segment in self._shared.items():
+            setattr(self, name, np.array(getattr(self, name)))
+            segment.close()
+            if self._owner:
+                segment.unlink()
+        self._shared = {}
+        self._owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_Q_view", None)  # a view of Q, made again when unpickled
+        # Shared arrays are pickled as the name of their segment, and not copied
+        for name, segment in self._shared.items():
+            array = state[name]
+            state[name] = (segment.name, array.shape, array.dtype.str)
+        state["_shared"] = {name: None for name in self._shared}
+        state["_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in self._shared:
+            segment_name, shape, dtype = state[name]
+            # Processes started by multiprocessing share the resource tracker of the owner, so attaching here
+            # does not take over the segment. Since Python 3.13 it is not tracked at all.
+            kwargs = {"track": False} if sys.version_info >= (3, 13) else {}
+            segment = shared_memory.SharedMemory(name=segment_name, **kwargs)
+            # Not through setattr, the greedy table attached is already up to date
+            self.__dict__[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+            self._shared[name] = segment
+        if self.__dict__.get("Q") is not None:
+            self.__dict__["_Q_view"] = _read_only(self.__dict__["Q"])
 
     def load(self, filename):
         """ Load model from file. """
@@ -36,6 +237,330 @@ class AbstractModel(ABC):
     def predict(self, state):
         pass
 
+    def update_greedy(self, states=None):
+        """
+        Update the greedy table from the Q-table, for the given states only: the learners call it for every state
+        they update through _Q. Anything else can only write into the Q-table by assigning it or in editing_q(),
+        which refresh the whole table. The greedy action is Action.HIT or Action.STICK, TIE if both actions tie.
+        :param states: flat state index (see q_state_index) or array of them, all the states by default.
+        :type states: Union[int, numpy.array]
+        """
+        Q = self.Q.reshape(-1, 2)
+        if states is None:
+            if self.greedy is None:
+                self.greedy = np.empty(Q.shape[0], dtype=np.int64).reshape(self.Q.shape[:-1])
+            states = slice(None)
+        elif isinstance(states, (int, np.integer)):
+            hit, stick = Q[states]
+            self.greedy.flat[states] = TIE if hit == stick else core.Action.HIT if hit > stick else core.Action.STICK
+            return
+        q = Q[states]
+        self.greedy.reshape(-1)[states] = np.where(q[:, 0] == q[:, 1], TIE, q.argmax(axis=1))
+
+    def freeze(self):
+        """
+        Inference mode: predict and predict_batch serve the greedy policy from a table alone, a single lookup per
+        decision, without exploration. Ties are broken at random once and for all here. The policy is the greedy one
+        of the Q-table at the time of the call, until unfreeze() or freeze() again, and a frozen model refuses to train.
+        :return: the model itself
+        """
+        policy = np.array(self.greedy)
+        ties = policy == TIE
+        policy[ties] = self.random.rng.integers(2, size=np.count_nonzero(ties))
+        self.frozen = policy
+        return self
+
+    def unfreeze(self):
+        self.frozen = None
+
+    def greedy_action(self, state: tuple):
+        """
+        Greedy action of an observation from the greedy table, a tie is broken at random (the frozen policy is fixed).
+        """
+        index = q_state_index(state)
+        if self.frozen is not None:
+            return self.frozen.flat[index]
+        action = self.greedy.flat[index]
+        return self.random.integers(2) if action == TIE else action
+
+    def predict_batch(self, states, rng=None):
+        """
+        Actions for a batch of observations, in one vectorized call.
+        Models with a Q-table act as their epsilon-greedy predict does (exploration_rate, ties broken at random) from
+        the greedy table, or from the frozen policy alone, other models call predict state by state.
+        :param states: observations (PlayerSum, DealerShow, UsableAce), array of shape (k, 3)
+        :type states: numpy.array
+        :param rng: random generator of the exploration and the tie-breaking, by default the model's one.
+        :type rng: numpy.random.Generator
+        :rtype: numpy.array of shape (k, )
+        """
+        if self.Q is None:
+            return np.array([self.predict(state=tuple(state)) for state in np.asarray(states).tolist()],
+                            dtype=np.int64)
+        indices = q_state_indices(np.asarray(states))
+        if self.frozen is not None:
+            return self.frozen.reshape(-1)[indices]
+        rng = self.rng if rng is None else rng
+        actions = self.greedy.reshape(-1)[indices]
+        ties = actions == TIE
+        actions[ties] = rng.integers(2, size=np.count_nonzero(ties))
+        explore = rng.random(len(actions)) < getattr(self, "exploration_rate", 0)
+        actions[explore] = rng.integers(len(core.Action), size=np.count_nonzero(explore))
+        return actions
+
+
+class TabularModel(AbstractModel):
+    """
+    Template for models learning a Q-table with an epsilon-greedy policy from the episodes they play.
+    Subclasses implement the update step in learn().
+    """
+    shared_arrays = ("Q", "greedy")
+
+    def __init__(self, game, **kwargs):
+        super().__init__(game)
+        self.exploration_rate = kwargs.get("exploration_rate", 0.10)
+        self.gamma = kwargs.get("gamma", self.discount)
+        self.rng = kwargs.get("rng")  # exploration and tie-breaking, see core.default_rng
+        self.Q = np.zeros((10, 10, 2, 2))  # PlayerSum, DealerShow, UsableAce, Action
+
+    def save(self, filename):
+        np.savez(filename, **{"Q": self.Q})
+
+    def load(self, filename):
+        loader = np.load(file=filename)
+        if self.shared:
+            with self.editing_q() as Q:
+                Q[...] = loader.get("Q")
+        else:
+            self.Q = loader.get("Q")
+
+    @abstractmethod
+    def learn(self, rewards, player_trajectory, alpha):
+        """
+        Update the Q-table with one episode.
+        :param rewards: rewards to each gambler
+        :type rewards: numpy.array
+        :param player_trajectory: trajectory of each gambler, as returned by Blackjack.play
+        :type player_trajectory: List[List[(player_sum, dealer_showing, usable_ace), Action]]
+        :param alpha: learning rate
+        :type alpha: float
+        :return: all updates made on the Q-table
+        :rtype: list
+        """
+        pass
+
+    @abstractmethod
+    def update_batch(self, states, actions, rewards, next_states, next_actions, alpha):
+        """
+        Update the Q-table with a batch of transitions, as returned by transitions().
+        All the targets are computed from the Q-table before the batch, see scatter_update for the updates of a
+        state-action pair occurring several times in the batch.
+        :param states: flat indices of the states, see q_state_index
+        :type states: numpy.array
+        :param actions: actions taken
+        :type actions: numpy.array
+        :param rewards: final reward of the episode of each transition
+        :type rewards: numpy.array
+        :param next_states: flat indices of the next states, -1 if the transition ends the episode
+        :type next_states: numpy.array
+        :param next_actions: next actions taken, -1 if the transition ends the episode
+        :type next_actions: numpy.array
+        :param alpha: learning rate
+        :type alpha: float
+        :return: the update of each transition
+        :rtype: numpy.array
+        """
+        pass
+
+    def scatter_update(self, states, actions, errors, alpha):
+        """
+        Apply the errors (target - Q) of a batch of transitions to the Q-table.
+        A state-action pair occurring k times moves towards its average target by 1 - (1-alpha)^k, which is what k
+        sequential updates towards the same target would do. Summing the k updates instead would overshoot as soon as
+        k * alpha > 1, which is common for the frequent states in large batches.
+        :return: the update of each transition, those of a pair add up to the update of the pair.
+        :rtype: numpy.array
+        """
+        pairs = states * 2 + actions
+        occurrences = np.bincount(pairs, minlength=self.Q.size)
+        counts = occurrences[pairs]
+        updates = errors * ((1 - np.power(1 - alpha, counts)) / counts)
+        self._Q.reshape(-1)[...] += np.bincount(pairs, weights=updates, minlength=self.Q.size)
+        self.update_greedy(np.flatnonzero(occurrences.reshape(-1, 2).any(axis=1)))
+        return updates
+
+    def train(self, stop_at_convergence=True, **kwargs):
+        """
+        Train the model, with workers > 1 the episodes are played by parallel processes (see parallel_training.py).
+        A game playing batches of episodes (BatchBlackjack) is trained one batch at a time with update_batch.
+        The convergence is followed by self.monitor, see convergence.py for the stopping criteria.
+        With checkpoint (an .npz file), the whole training state is saved every checkpoint_every episodes and once
+        the training stops, see save_checkpoint. With resume=True an existing checkpoint is loaded first and the
+        training continues from it, exactly as if it had not been interrupted. The checkpoint of a run that is over
+        only loads the model. Parallel training does not save checkpoints.
+        """
+        if self.frozen is not None:
+            raise Exception("The model is frozen for inference, unfreeze() it before training.")
+        if kwargs.get("workers", 1) > 1:
+            if kwargs.get("checkpoint") is not None:
+                raise ValueError("Parallel training (workers > 1) does not save checkpoints, train with one process "
+                                 "to checkpoint and resume.")
+            from model.parallel_training import parallel_train
+            return parallel_train(self, stop_at_convergence=stop_at_convergence, **kwargs)
+
+        self.exploration_rate = kwargs.get("exploration_rate", 0.10)  # $\epsilon$
+        self.gamma = kwargs.get("gamma", 1)  # $\gamma$
+        exploration_decay = kwargs.get("exploration_decay", 0.995)  # $epsilon_{t+1} = epsilon_{t} * exploration_decay$
+        eps_min = kwargs.get("eps_min", 0.05)  # min epsilon
+        episodes = max(kwargs.get("episodes", 1000), 1)
+        learning_rate = kwargs.get("learning_rate", 0.01)
+        check_convergence_every = kwargs.get("check_convergence_every", self.check_convergence_every)
+        report_every = max(kwargs.get("report_every", int(episodes/10)), 1)
+        checkpoint = kwargs.get("checkpoint")
+        checkpoint_every = max(kwargs.get("checkpoint_every", report_every), 1)
+        # Settings saved in the checkpoints, resume() trains with them again
+        self.settings = {"stop_at_convergence": stop_at_convergence, "gamma": self.gamma, "eps_min": eps_min,
+                         "episodes": episodes, "learning_rate": learning_rate,
+                         "check_convergence_every": check_convergence_every, "report_every": report_every,
+                         "checkpoint_every": checkpoint_every}
+
+        self.monitor = ConvergenceMonitor(self, criteria=kwargs.get("criteria"))
+        alpha = learning_rate
+        start = 0
+        if kwargs.get("resume") and checkpoint is not None and os.path.exists(checkpoint):
+            start, stopped = self.load_checkpoint(checkpoint)
+            if stopped:
+                logger.warning("The run of {} is already over (episode {}), the model is loaded from it and not "
+                               "trained again. Remove the checkpoint to train again.".format(checkpoint, start))
+                return
+            logger.info("Resume training from episode {} of {}".format(start, checkpoint))
+
+        def save(episode, step=1, stopped=False):
+            if checkpoint is not None and (stopped or
+                                           episode // checkpoint_every > (episode - step) // checkpoint_every):
+                self.save_checkpoint(checkpoint, episode, stopped)
+
+        if hasattr(self.game, "play_batch"):
+            return self.__train_batch(start, episodes, alpha, eps_min, report_every, check_convergence_every,
+                                      stop_at_convergence, save)
+
+        episode = start
+        for episode in range(start + 1, episodes + 1):
+            self.exploration_rate = min(1.0 / episode, eps_min)
+            _, rewards, player_trajectory = self.game.play(self)
+            self.monitor.observe(self.learn(rewards, player_trajectory, alpha),
+                                 [q_state_index(obs) * 2 + action for trajectory in player_trajectory
+                                  for obs, action in trajectory])
+
+            if self.check(episode, episodes, self.monitor, report_every, check_convergence_every,
+                          stop_at_convergence):
+                break
+            save(episode)
+
+            # self.exploration_rate = min(self.exploration_rate*exploration_decay, eps_min)
+        save(episode, stopped=True)
+
+    def __train_batch(self, episode, episodes, alpha, eps_min, report_every, check_convergence_every,
+                      stop_at_convergence, save):
+        while episode < episodes:
+            self.exploration_rate = min(1.0 / (episode + 1), eps_min)
+            _, rewards, (observations, actions, lengths) = self.game.play_batch(self)
+            size = min(len(rewards), episodes - episode)
+            batch = transitions(rewards[:size], observations[:size], actions[:size], lengths[:size])
+            self.monitor.observe(self.update_batch(*batch, alpha), batch[0] * 2 + batch[1])
+            episode += size
+
+            if self.check(episode, episodes, self.monitor, report_every, check_convergence_every,
+                          stop_at_convergence, size):
+                break
+            save(episode, size)
+        save(episode, stopped=True)
+
+    def save_checkpoint(self, filename, episode, stopped=False):
+        """
+        Save the training state to an .npz file: Q-table (so load() reads it as a saved model), episodes played,
+        exploration rate, training settings, random generators and buffers of the model and of the game, and the
+        statistics of self.monitor. The file is replaced atomically, an interrupted run leaves the previous one.
+        :param episode: number of episodes played.
+        :type episode: int
+        :param stopped: whether the training is over (converged or all the episodes played).
+        :type stopped: bool
+        """
+        state = {"Q": self.Q, "episode": episode, "stopped": stopped, "exploration_rate": self.exploration_rate,
+                 "settings": json.dumps(self.settings), "random": self.random.checkpoint(),
+                 "monitor": self.monitor.checkpoint()}
+        if hasattr(self.game, "checkpoint"):
+            state["game"] = self.game.checkpoint()
+        temporary = "{}.tmp".format(filename)
+        with open(temporary, "wb") as f:
+            np.savez(f, **dict(_flatten(state)))
+        os.replace(temporary, filename)
+
+    def load_checkpoint(self, filename):
+        """
+        Restore the training state saved by save_checkpoint, self.monitor has to be created beforehand.
+        :return: number of episodes played, and whether the training was over.
+        :rtype: (int, bool)
+        """
+        with np.load(filename) as loader:
+            state = _unflatten({key: loader[key] for key in loader.files})
+        with self.editing_q() as Q:
+            Q[...] = state["Q"]
+        self.exploration_rate = float(state["exploration_rate"])
+        self.random.restore(state["random"])
+        self.monitor.restore(state["monitor"])
+        if "game" in state:
+            self.game.restore(state["game"])
+        return int(state["episode"]), bool(state["stopped"])
+
+    def resume(self, filename, **kwargs):
+        """
+        Continue the training saved in a checkpoint, with the settings it was started with (kwargs override them).
+        The stopping criteria are not saved, pass them again if they are not the default ones.
+        """
+        with np.load(filename) as loader:
+            settings = json.loads(str(loader["settings"]))
+        settings.update(kwargs, checkpoint=filename, resume=True)
+        return self.train(**settings)
+
+    def check(self, episode, episodes, monitor, report_every, check_convergence_every, stop_at_convergence, step=1):
+        """
+        Report the training progress and check the convergence.
+        :param monitor: statistics of the training.
+        :type monitor: ConvergenceMonitor
+        :param step: number of episodes played since the last check.
+        :return: whether the training should stop.
+        :rtype: bool
+        """
+        def every(k):
+            return episode // k > (episode - step) // k
+
+        if every(report_every):
+            logger.info(
+                "Episode {:4d}/{}: epsilon = {:.4e} | {:3d} unseen pairs | average last 100 updates = {:.5f} | "
+                "EWMA of updates = {:.5f} | {} policy changes"
+                .format(episode, episodes, self.exploration_rate, len(monitor.visited) - monitor.n_visited,
+                        monitor.mean_update, monitor.ewma, monitor.policy_changes)
+            )
+
+        if every(check_convergence_every):
+            criterion = monitor.check()
+            if criterion is not None and stop_at_convergence:
+                logger.info("CONVERGENCE: {}".format(criterion))
+                return True
+        return False
+
+    def q(self, obs: tuple):
+        # obs_index = tuple(np.array(obs) - np.array([12, 1, 0]))  # "PlayerSum", "DealerShow", "UsableAce"
+        return self.Q.reshape(-1, 2)[q_state_index(obs)]
+
+    def predict(self, state: tuple):
+        if self.frozen is None and self.random.random() < self.exploration_rate:
+            action = self.game.actions[self.random.integers(len(self.game.actions))]
+            return action
+        else:
+            return self.greedy_action(state)
+
 
 class TestModel(AbstractModel):
     """
@@ -54,3 +579,5 @@ class TestModel(AbstractModel):
             return core.Action.HIT
         return core.Action.STICK
 
+    def predict_batch(self, states, rng=None):
+        return np.where(np.asarray(states)[:, 0] < 20, core.Action.HIT, core.Action.STICK)
@@ -0,0 +1,211 @@
+import numpy as np
+
+"""
+Convergence monitoring of the training of tabular models.
+The monitor keeps running statistics of the updates made on the Q-table, each of them updated at a constant cost
+per update, and stops the training once one of its stopping criteria is met. A criterion is any callable taking the
+monitor and returning whether the training has converged, e.g.
+    model.train(criteria=[PolicyStable(checks=200), CloseTo(DP.Q, tolerance=0.05)])
+"""
+
+
+class MeanUpdate(object):
+    """
+    Converged once the average magnitude of the last updates is not greater than threshold (the original rule).
+    """
+    def __init__(self, threshold=1e-3):
+        self.threshold = threshold
+
+    def __call__(self, monitor):
+        return monitor.filled > 0 and monitor.mean_update <= self.threshold
+
+    def __str__(self):
+        return "Average updates of last iterates is smaller than {}.".format(self.threshold)
+
+
+class PolicyStable(object):
+    """
+    Converged once the greedy policy has not changed across a number of consecutive checks, after a fraction of the
+    state-action pairs has been visited (the policy of an unvisited state is meaningless).
+    """
+    def __init__(self, checks=100, min_visited=0.9):
+        """
+        :param checks: consecutive checks without any change of the greedy policy.
+        :type checks: int
+        :param min_visited: fraction of the state-action pairs visited before the policy is considered.
+        :type min_visited: float
+        """
+        self.checks = checks
+        self.min_visited = min_visited
+
+    def __call__(self, monitor):
+        return monitor.visited_fraction >= self.min_visited and monitor.stable_checks >= self.checks
+
+    def __str__(self):
+        return "Greedy policy unchanged for {} checks.".format(self.checks)
+
+
+class CloseTo(object):
+    """
+    Converged once the mean absolute distance of the Q-table to a reference one (e.g. solved by DynamicProgramming),
+    over the visited state-action pairs, is not greater than tolerance.
+    """
+    def __init__(self, reference, tolerance=0.05):
+        """
+        :param reference: reference Q-table, of the same shape as the trained one.
+        :type reference: numpy.array
+        :param tolerance: mean absolute distance to reach.
+        :type tolerance: float
+        """
+        self.reference = np.asarray(reference).reshape(-1)
+        self.tolerance = tolerance
+
+    def __call__(self, monitor):
+        visited = monitor.visited
+        if not visited.any():
+            return False
+        monitor.distance = np.abs(monitor.model.Q.reshape(-1)[visited] - self.reference[visited]).mean()
+        return monitor.distance <= self.tolerance
+
+    def __str__(self):
+        return "Mean distance to the reference Q-table is smaller than {}.".format(self.tolerance)
+
+
+class ConvergenceMonitor(object):
+    """
+    Running statistics of the training of a tabular model:
+        mean_update:    average magnitude of the last `window` updates, kept in a ring buffer with its running sum
+        ewma:           exponentially weighted moving average of the update magnitudes
+        n_visited:      number of state-action pairs updated at least once
+        policy_changes: number of changes of the greedy policy seen by the checks, stable_checks the number of
+                        consecutive checks without any
+    """
+    def __init__(self, model, criteria=None, window=100, halflife=100):
+        """
+        :param model: the model trained, with a Q-table.
+        :type model: TabularModel
+        :param criteria: stopping criteria, the training stops once any of them is met. MeanUpdate() by default.
+        :type criteria: List[Callable[[ConvergenceMonitor], bool]]
+        :param window: number of last updates averaged in mean_update.
+        :type window: int
+        :param halflife: number of updates after which the weight of an update in ewma is halved.
+        :type halflife: float
+        """
+        self.model = model
+        self.criteria = [MeanUpdate()] if criteria is None else list(criteria)
+        self.rate = 1 - 0.5 ** (1 / halflife)
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.recent = [0.0] * self.window  # magnitudes of the last updates, a ring buffer
+        self.position = 0  # next position written in the ring buffer
+        self.filled = 0  # number of updates in the ring buffer
+        self.recent_sum = 0.0
+        self.ewma = 0.0
+        self.updates = 0  # number of updates observed
+        self.visited = np.zeros(self.model.Q.size, dtype=bool)  # flat index of the pair: state * 2 + action
+        self.n_visited = 0
+        self.policy = self.greedy_policy()
+        self.policy_changes = 0
+        self.stable_checks = 0
+        self.checks = 0
+        self.distance = np.nan  # distance to the reference Q-table, see CloseTo
+
+    def checkpoint(self) -> dict:
+        """
+        Running statistics, restore() continues them exactly. The criteria are not part of it.
+        """
+        return {"recent": np.array(self.recent), "position": self.position, "filled": self.filled,
+                "recent_sum": self.recent_sum, "ewma": self.ewma, "updates": self.updates,
+                "visited": self.visited.copy(), "n_visited": self.n_visited, "policy": self.policy.copy(),
+                "policy_changes": self.policy_changes, "stable_checks": self.stable_checks, "checks": self.checks,
+                "distance": self.distance}
+
+    def restore(self, state: dict):
+        self.recent = np.asarray(state["recent"], dtype=float).tolist()
+        self.window = len(self.recent)
+        self.position, self.filled, self.updates = int(state["position"]), int(state["filled"]), int(state["updates"])
+        self.recent_sum, self.ewma, self.distance = (float(state["recent_sum"]), float(state["ewma"]),
+                                                     float(state["distance"]))
+        self.visited = np.array(state["visited"], dtype=bool)
+        self.n_visited = int(state["n_visited"])
+        self.policy = np.array(state["policy"])
+        self.policy_changes, self.stable_checks, self.checks = (int(state["policy_changes"]),
+                                                                int(state["stable_checks"]), int(state["checks"]))
+
+    @property
+    def mean_update(self):
+        return self.recent_sum / self.filled if self.filled else np.nan
+
+    @property
+    def visited_fraction(self):
+        return self.n_visited / len(self.visited)
+
+    def greedy_policy(self):
+        return self.model.Q.reshape(-1, 2).argmax(axis=1)
+
+    def observe(self, updates, pairs=None):
+        """
+        Add the updates made on the Q-table.
+        :param updates: the updates, as returned by learn or update_batch.
+        :type updates: Union[list, numpy.array]
+        :param pairs: flat indices (state * 2 + action, see q_state_index) of the pairs updated, if known.
+        :type pairs: Union[list, numpy.array]
+        """
+        window = len(self.recent)
+        k = len(updates)
+        self.updates += k
+        self.filled = min(self.filled + k, window)
+        if isinstance(updates, np.ndarray):
+            if k >= window:
+                # A large batch, only its last updates stay in the ring buffer
+                updates = np.abs(updates)
+                decay = 1 - self.rate
+                weights = self.rate * np.power(decay, np.arange(k - 1, -1, -1))
+                self.ewma = decay ** k * self.ewma + weights @ updates
+                self.recent = updates[-window:].tolist()
+                self.recent_sum = sum(self.recent)
+                self.position = 0
+                updates = ()
+            else:
+                updates = updates.tolist()
+
+        rate, recent, position, recent_sum, ewma = self.rate, self.recent, self.position, self.recent_sum, self.ewma
+        for update in updates:
+            update = abs(update)
+            ewma += rate * (update - ewma)
+            recent_sum += update - recent[position]
+            recent[position] = update
+            position += 1
+            if position == window:
+                position = 0
+                recent_sum = sum(recent)  # once in a while, not to drift away
+        self.position, self.recent_sum, self.ewma = position, recent_sum, ewma
+
+        if pairs is not None:
+            if isinstance(pairs, np.ndarray):
+                new = np.flatnonzero(np.bincount(pairs, minlength=len(self.visited)).astype(bool) & ~self.visited)
+                self.visited[new] = True
+                self.n_visited += len(new)
+            else:
+                for pair in pairs:
+                    if not self.visited[pair]:
+                        self.visited[pair] = True
+                        self.n_visited += 1
+
+    def check(self):
+        """
+        Compare the greedy policy with the one of the last check, and evaluate the stopping criteria.
+        :return: the first criterion met, None if the training has not converged.
+        """
+        policy = self.greedy_policy()
+        changes = np.count_nonzero(policy != self.policy)
+        self.policy = policy
+        self.policy_changes += changes
+        self.stable_checks = 0 if changes else self.stable_checks + 1
+        self.checks += 1
+        for criterion in self.criteria:
+            if criterion(self):
+                return criterion
+        return None
@@ -1,3 +1,4 @@
+import numpy as np
 from model.abstract_model import AbstractModel
 from environment import core
 
@@ -23,3 +24,7 @@ class DealerPolicy(AbstractModel):
             return core.Action.STICK
         else:
             return core.Action.HIT
+
+    @classmethod
+    def predict_batch(cls, states, rng=None):
+        return np.where(np.asarray(states)[:, 0] >= 17, core.Action.STICK, core.Action.HIT)
@@ -0,0 +1,149 @@
+import multiprocessing
+import time
+from statistics import NormalDist
+
+import numpy as np
+
+from environment.batch_blackjack import BatchBlackjack
+from environment.blackjack import Table
+from environment.core import default_rng
+from model.abstract_model import AbstractModel, q_state_index
+
+"""
+Large-sample evaluation of a policy: the expected return per hand, with a confidence interval.
+Hands are played on BatchBlackjack tables without recording the trajectories, in tasks of `rounds` rounds of
+`batch_size` tables spread over worker processes, each task drawing from its own stream spawned from the seed. The
+result does not depend on the number of workers, e.g.
+    result = evaluate("record/npz/MC_m0_n2_e5e+05.npz", Table(0, 2), hands=10**6, seed=0)
+    print(result)  # -0.0020 +- 0.0018 per hand (95% CI, 1000000 hands)
+"""
+
+
+class GreedyPolicy(AbstractModel):
+    """
+    The frozen greedy policy of a Q-table: no exploration, ties broken at random as TabularModel.predict does.
+    """
+    def __init__(self, Q, rng=None):
+        """
+        :param Q: Q-table of shape (10, 10, 2, 2), or the .npz file of a saved model.
+        :type Q: Union[numpy.array, str]
+        :param rng: random generator breaking ties, or its seed, see default_rng.
+        """
+        super().__init__(game=None)
+        if not isinstance(Q, np.ndarray):
+            with np.load(Q) as loader:
+                Q = loader["Q"]
+        self.Q = np.array(Q, dtype=float)
+        self.exploration_rate = 0
+        self.rng = rng
+
+    def q(self, obs: tuple):
+        return self.Q.reshape(-1, 2)[q_state_index(obs)]
+
+    def predict(self, state: tuple):
+        return self.greedy_action(state)
+
+
+class Evaluation(object):
+    """
+    Expected return per hand of a policy, estimated from the hands played:
+        mean:       average reward per hand of a gambler
+        stderr:     standard error of mean. The gamblers of a table are not independent, so it is computed
+                    from the average reward of the gamblers of every round
+        ci:         (low, high) confidence interval of the expected return
+        seat_means: average reward of every seat, the first gambler plays first
+    """
+    def __init__(self, hands, rounds, total, total_squares, round_total, round_squares, seat_totals, confidence,
+                 seconds):
+        self.hands = hands
+        self.rounds = rounds
+        self.confidence = confidence
+        self.seconds = seconds
+        self.mean = total / hands
+        self.std = np.sqrt(max(total_squares / hands - self.mean ** 2, 0))  # of the reward of one hand
+        round_mean = round_total / rounds
+        self.stderr = np.sqrt(max(round_squares / rounds - round_mean ** 2, 0) / max(rounds - 1, 1))
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.ci = (self.mean - z * self.stderr, self.mean + z * self.stderr)
+        self.seat_means = seat_totals / rounds
+
+    def __repr__(self):
+        return "{:.4f} +- {:.4f} per hand ({:.0%} CI, {} hands)".format(self.mean, self.ci[1] - self.mean,
+                                                                       self.confidence, self.hands)
+
+
+_policy = None  # The policy evaluated by a worker process
+
+
+def _init_worker(policy):
+    global _policy
+    _policy = policy
+
+
+def _play(m, n, penetration, batch_size, rounds, seed):
+    """
+    Play rounds on batch_size tables, with the shoes of the tables carried over the rounds.
+    :param seed: SeedSequence of the task, the decks and the tie-breaking draw from a generator started with it.
+    :return: sums of the rewards, of their squares, of the averages of the rounds and of their squares, and of the
+        rewards of every seat.
+    """
+    rng = default_rng(seed)
+    if hasattr(_policy, "random"):
+        _policy.rng = rng
+    game = BatchBlackjack(Table(m, n, penetration, rng=rng), batch_size=batch_size)
+    sums = np.zeros(4)
+    seat_totals = np.zeros(n - 1)
+    for _ in range(rounds):
+        rewards = game.play_batch(_policy, record=False)[1]
+        round_means = rewards.mean(axis=1)
+        sums += (rewards.sum(), np.square(rewards).sum(), round_means.sum(), np.square(round_means).sum())
+        seat_totals += rewards.sum(axis=0)
+    return sums, seat_totals
+
+
+def evaluate(policy, table: Table, hands=10**6, workers=0, confidence=0.95, batch_size=16384, rounds=8, seed=None):
+    """
+    Play a policy for (at least) the given number of hands, over all the cores, and estimate its expected return.
+    :param policy: a model with a Q-table (its greedy policy is evaluated), a Q-table, the .npz file of a saved model,
+        or any other model, whose predict is then called state by state (slowly).
+    :type policy: Union[AbstractModel, numpy.array, str]
+    :param table: the configuration played, only its m, n and penetration are used.
+    :type table: Table
+    :param hands: number of hands, i.e. rounds of one gambler. Every round of n players plays n-1 hands.
+    :type hands: int
+    :param workers: number of worker processes, 0 for all the cores.
+    :type workers: int
+    :param confidence: level of the confidence interval.
+    :type confidence: float
+    :param batch_size: number of tables played at once.
+    :type batch_size: int
+    :param rounds: rounds played by the tables of a task. With a penetration, the shoes start full at every task.
+    :type rounds: int
+    :param seed: seed of the tasks, each of them is played with a stream spawned from it (SeedSequence.spawn).
+    :type seed: int
+    :rtype: Evaluation
+    """
+    if isinstance(policy, AbstractModel) and getattr(policy, "Q", None) is not None:
+        policy = policy.Q
+    if not isinstance(policy, AbstractModel):
+        policy = GreedyPolicy(policy)
+    m, n, penetration = table.m, table.n, table.decks.penetration
+    rounds_needed = -(-hands // (n - 1))
+    tasks = -(-rounds_needed // (batch_size * rounds))
+    batch_size = min(batch_size, -(-rounds_needed // (tasks * rounds)))
+    seeds = np.random.SeedSequence(np.random.randint(np.iinfo(np.int64).max) if seed is None else seed).spawn(tasks)
+    arguments = [(m, n, penetration, batch_size, rounds, s) for s in seeds]
+
+    start = time.perf_counter()
+    workers = min(workers or multiprocessing.cpu_count(), tasks)
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(policy,)) as pool:
+            results = pool.starmap(_play, arguments)
+    else:
+        _init_worker(policy)
+        results = [_play(*args) for args in arguments]
+    sums = np.sum([r[0] for r in results], axis=0)
+    seat_totals = np.sum([r[1] for r in results], axis=0)
+    played = tasks * rounds * batch_size
+    return Evaluation(played * (n - 1), played, sums[0], sums[1], sums[2], sums[3], seat_totals, confidence,
+                      time.perf_counter() - start)
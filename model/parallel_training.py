@@ -0,0 +1,110 @@
+import multiprocessing
+from collections import deque
+
+import numpy as np
+from loguru import logger
+
+from environment.batch_blackjack import BatchBlackjack
+from model.abstract_model import TabularModel, transitions
+from model.convergence import ConvergenceMonitor
+
+"""
+Parallel training: worker processes own a copy of the model and a BatchBlackjack on the table of its game, and play
+batches of episodes. The Q-table is placed in shared memory, so workers always act on the live values updated by the
+learner (main process), which keeps `workers` batches in flight. Workers send back the transitions of a batch as
+flat arrays (see transitions()), and the learner applies them at once with update_batch, so that its share of the
+work stays small next to playing the episodes.
+"""
+
+_model = None  # The model owned by a worker process
+_game = None  # The game of the worker, playing a batch of episodes at once
+
+
+def _init_worker(model, batch_size):
+    global _model, _game
+    logger.disable("environment.blackjack")
+    _model = model
+    _game = BatchBlackjack(model.game.table, batch_size=batch_size)
+
+
+def _play(exploration_rate, episodes, seed):
+    """
+    Play a batch of episodes in a worker with the given policy.
+    :param seed: SeedSequence of the batch, the game and the model draw from a generator started with it.
+    :return: states, actions, rewards, next_states and next_actions of the decisions of the batch, see transitions().
+    :rtype: (numpy.array, numpy.array, numpy.array, numpy.array, numpy.array)
+    """
+    _model.rng = np.random.default_rng(seed)
+    _game.rng = _model.rng
+    _model.exploration_rate = exploration_rate
+    _, rewards, (observations, actions, lengths) = _game.play_batch(_model)
+    states, actions, rewards, next_states, next_actions = transitions(rewards[:episodes], observations[:episodes],
+                                                                      actions[:episodes], lengths[:episodes])
+    # Compact types, less to pickle
+    return (states.astype(np.int16), actions.astype(np.int8), rewards.astype(np.float32),
+            next_states.astype(np.int16), next_actions.astype(np.int8))
+
+
+def parallel_train(model: TabularModel, stop_at_convergence=True, **kwargs):
+    """
+    Train a model with episodes played by parallel worker processes, same hyper parameters as TabularModel.train.
+    Every batch of episodes is learned at once with update_batch, as TabularModel.train does on a BatchBlackjack.
+    :param model: the model to train
+    :type model: TabularModel
+    :param workers: number of worker processes, 0 for all the cores.
+    :type workers: int
+    :param sync_every: number of episodes a worker plays before sending them to the learner.
+    :type sync_every: int
+    :param seed: seed of the batches of episodes, each of them is played with a stream spawned from it
+        (SeedSequence.spawn). By default it is drawn from the model's random generator. The workers act on the live
+        Q-table, which depends on the timing of the processes, so a run can not be repeated from its seed.
+    :type seed: int
+    """
+    if getattr(model.game, "table", None) is None:
+        raise ValueError("Parallel training plays on the table of the model's game, {} has none: train with one "
+                         "process (workers=1).".format(type(model.game).__name__))
+    workers = kwargs.get("workers", 0) or multiprocessing.cpu_count()
+    sync_every = max(kwargs.get("sync_every", 100), 1)
+    model.gamma = kwargs.get("gamma", 1)  # $\gamma$
+    eps_min = kwargs.get("eps_min", 0.05)  # min epsilon
+    episodes = max(kwargs.get("episodes", 1000), 1)
+    learning_rate = kwargs.get("learning_rate", 0.01)
+    check_convergence_every = kwargs.get("check_convergence_every", model.check_convergence_every)
+    report_every = max(kwargs.get("report_every", int(episodes/10)), 1)
+
+    model.monitor = ConvergenceMonitor(model, criteria=kwargs.get("criteria"))
+    alpha = learning_rate
+    episode = 0  # episodes learned
+    submitted = 0  # episodes sent to workers
+    pending = deque()
+    seeds = np.random.SeedSequence(kwargs.get("seed", model.rng.integers(2**63)))
+
+    owner = not model.shared
+    model.share()
+    try:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model, sync_every)) as pool:
+            def submit():
+                nonlocal submitted
+                size = min(sync_every, episodes - submitted)
+                exploration_rate = min(1.0 / (submitted + 1), eps_min)
+                pending.append((size, pool.apply_async(_play, (exploration_rate, size, seeds.spawn(1)[0]))))
+                submitted += size
+
+            while submitted < episodes and len(pending) < workers:
+                submit()
+
+            while pending:
+                size, result = pending.popleft()
+                batch = result.get()
+                episode += size
+                model.exploration_rate = min(1.0 / episode, eps_min)
+                model.monitor.observe(model.update_batch(*batch, alpha), batch[0] * 2 + batch[1])
+                if model.check(episode, episodes, model.monitor, report_every, check_convergence_every,
+                               stop_at_convergence, size):
+                    break
+                if submitted < episodes:
+                    submit()
+    finally:
+        if owner:
+            model.release()
+    return episode
@@ -0,0 +1,294 @@
+import multiprocessing
+import pickle
+
+import numpy as np
+import pytest
+
+from loguru import logger
+from environment import blackjack
+from environment.batch_blackjack import BatchBlackjack
+from environment.numba_engine import CompiledBlackjack
+from environment.util import ExperienceReplay
+from model.DynamicProgramming import DynamicProgramming, dealer_distribution, DEALER_OUTCOMES
+from model.abstract_model import q_obs_index, q_state_index, q_state_indices, TIE, TestModel as FixedPolicy
+from model.MonteCarloControl import MonteCarloControl
+from model.SARSA import SARSA
+from model.QLearning import QLearning
+from model.parallel_training import parallel_train
+from model.convergence import ConvergenceMonitor, PolicyStable, CloseTo
+from model.evaluation import evaluate
+from model.MonteCarloLearning import MonteCarloEvaluator
+from model.dealer_policy import DealerPolicy
+
+
+@pytest.fixture
+def game(request):
+    table = blackjack.Table(*request.param)
+    game = blackjack.Blackjack(table=table)
+    return game
+
+
+def test_dealer_distribution():
+    np.random.seed(0)
+    batch = BatchBlackjack(blackjack.Table(0, 2), batch_size=200000)
+    batch.play_batch(DynamicProgramming(None))
+    final_points = np.where(batch.raw[:, -1] > 21, 0, batch.points[:, -1])
+    for show in range(1, 11):
+        expected = dealer_distribution(show)
+        observed = final_points[batch.dealer_face_up == show]
+        assert expected.sum() == pytest.approx(1)
+        assert np.allclose([np.mean(observed == d) for d in DEALER_OUTCOMES], expected, atol=0.02)
+
+
+@pytest.mark.parametrize("game", [(0, 2)], indirect=True, ids=str)
+def test_dynamic_programming(game, tmp_path):
+    logger.disable("model.DynamicProgramming")
+    np.random.seed(0)
+    model = DynamicProgramming(game)
+    model.train()
+    model.save(tmp_path / "DP.npz")
+    loaded = DynamicProgramming(game)
+    loaded.load(tmp_path / "DP.npz")
+    assert np.array_equal(loaded.Q, model.Q)
+
+    batch = BatchBlackjack(game.table, batch_size=500000)
+    rewards = batch.play_batch(model)[1]
+    assert rewards.mean() == pytest.approx(model.expected_return, abs=0.01)
+
+
+@pytest.mark.parametrize("game, model", [((0, 2), MonteCarloControl), ((1, 3), SARSA), ((3, 4), QLearning)],
+                         indirect=["game"], ids=str)
+def test_parallel_train(game, model):
+    logger.disable("environment.blackjack")
+    policy = model(game)
+    episodes = parallel_train(policy, workers=2, sync_every=50, episodes=400, stop_at_convergence=False)
+    assert episodes == 400
+    assert np.count_nonzero(policy.Q) > 0
+    with pytest.raises(ValueError):
+        parallel_train(model(ExperienceReplay(None)), workers=2)  # a game without table
+
+
+def _add_one(model):
+    with model.editing_q() as Q:
+        Q += 1
+
+
+def test_shared_q():
+    model = MonteCarloControl(None)
+    with model.share():
+        assert len(pickle.dumps(model)) < model.Q.nbytes
+        process = multiprocessing.get_context("spawn").Process(target=_add_one, args=(model,))
+        process.start()
+        process.join()
+        assert np.all(model.Q == 1)
+        with pytest.raises(ValueError):
+            model.Q[0, 0, 0, 0] = 2  # read-only, shared or not
+    assert not model.shared
+    assert np.all(model.Q == 1)
+
+
+def test_state_index():
+    Q = np.random.random((10, 10, 2, 2))
+    observations = [(p, d, a) for p in range(2, 22) for d in range(1, 11) for a in range(2)]
+    for obs in observations:
+        assert np.array_equal(Q.reshape(-1, 2)[q_state_index(obs)], Q[q_obs_index(obs)])
+    indices = q_state_indices(np.array(observations))
+    assert np.array_equal(indices, [q_state_index(obs) for obs in observations])
+    assert indices.min() == 0 and indices.max() == 199
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_reproducible(batch):
+    logger.disable("model.abstract_model")
+    Q = []
+    for i in range(2):
+        rng = np.random.default_rng(7)  # a single seed for the decks and the model
+        table = blackjack.Table(1, 3, rng=rng)
+        game = BatchBlackjack(table, batch_size=100) if batch else blackjack.Blackjack(table, trace=False)
+        model = SARSA(game, rng=rng)
+        model.train(episodes=300, stop_at_convergence=False)
+        Q.append(model.Q)
+    assert np.count_nonzero(Q[0]) > 0
+    assert np.array_equal(Q[0], Q[1])
+
+
+def test_predict_batch():
+    states = np.array([(p, d, a) for p in range(12, 22) for d in range(1, 11) for a in range(2)] * 50)
+    for model in (FixedPolicy(), DealerPolicy()):
+        assert np.array_equal(model.predict_batch(states), [model.predict(tuple(s)) for s in states])
+
+    model = SARSA(None, exploration_rate=0, rng=0)
+    model.Q = np.stack([np.ones((10, 10, 2)), np.zeros((10, 10, 2))], axis=-1)  # HIT everywhere
+    assert np.all(model.predict_batch(states) == 0)
+    with pytest.raises(ValueError):
+        model.Q[..., 1] = 2  # the greedy table would go stale
+    with model.editing_q() as Q:
+        Q[..., 1] = 2
+    assert np.all(model.predict_batch(states) == 1)
+    with model.editing_q() as Q:
+        Q[0, 0, 0] = (2, 2)  # a tie is broken at random
+    tie = np.all(states == (12, 1, 0), axis=1)
+    assert 0.4 < model.predict_batch(states, np.random.default_rng(0))[tie].mean() < 0.6
+    model.exploration_rate = 1
+    assert 0.4 < model.predict_batch(states).mean() < 0.6
+
+
+def test_greedy_table():
+    def greedy(Q):
+        Q = Q.reshape(-1, 2)
+        return np.where(Q[:, 0] == Q[:, 1], TIE, Q.argmax(axis=1)).reshape(10, 10, 2)
+
+    for game in (blackjack.Blackjack(blackjack.Table(0, 3, rng=0), trace=False),
+                 BatchBlackjack(blackjack.Table(0, 3, rng=0), batch_size=100)):
+        model = QLearning(game, rng=0)
+        model.train(episodes=2000, stop_at_convergence=False)
+        assert np.array_equal(model.greedy, greedy(model.Q))  # updated state by state
+
+    states = np.array([(p, d, a) for p in range(12, 22) for d in range(1, 11) for a in range(2)])
+    model.freeze()
+    assert np.all(model.frozen != TIE)
+    assert np.array_equal(model.frozen[model.greedy != TIE], model.greedy[model.greedy != TIE])
+    actions = model.predict_batch(states)
+    assert np.array_equal(actions, model.frozen.reshape(-1))
+    assert np.array_equal(actions, [model.predict(tuple(s)) for s in states])
+    with pytest.raises(Exception):
+        model.train(episodes=10)
+    model.unfreeze()
+    model.Q = np.zeros_like(model.Q)
+    assert np.all(model.greedy == TIE)
+
+
+def test_frozen_compiled():
+    # The compiled engine serves the frozen policy too, whatever the exploration rate and the ties of the Q-table
+    logger.disable("environment.blackjack")
+    model = QLearning(None, exploration_rate=0.5, rng=0)
+    model.Q = np.round(np.random.RandomState(0).random(model.Q.shape), 1)
+    model.freeze()
+    for play in (blackjack.Blackjack(blackjack.Table(6, 3, rng=0), trace=False).play,
+                 CompiledBlackjack(blackjack.Table(6, 3, rng=0)).play_compiled):
+        decisions = [decision for i in range(500) for trajectory in play(model)[2] for decision in trajectory]
+        observations, actions = np.array([obs for obs, action in decisions]), [action for obs, action in decisions]
+        assert np.array_equal(actions, model.frozen.reshape(-1)[q_state_indices(observations)])
+
+
+def test_convergence_monitor():
+    logger.disable("model.abstract_model")
+    model = MonteCarloControl(BatchBlackjack(blackjack.Table(0, 2, rng=0), batch_size=500), rng=0)
+    model.train(episodes=100000, criteria=[lambda monitor: monitor.updates >= 5000])
+    assert 5000 <= model.monitor.updates < 10000
+    assert model.monitor.n_visited >= np.count_nonzero(model.Q)  # some updates are 0
+    assert model.monitor.mean_update == pytest.approx(np.mean(model.monitor.recent))
+
+    with model.editing_q() as Q:
+        Q[0, 0, 0] = (1, 0)
+    monitor = ConvergenceMonitor(model, criteria=[PolicyStable(checks=3, min_visited=0), CloseTo(model.Q + 1)])
+    assert [monitor.check() for i in range(3)] == [None, None, monitor.criteria[0]]
+    with model.editing_q() as Q:
+        Q[0, 0, 0] = (0, 1)  # the greedy action changes
+    assert monitor.check() is None
+    assert (monitor.policy_changes, monitor.stable_checks) == (1, 0)
+
+
+def test_evaluate(tmp_path):
+    logger.disable("model.DynamicProgramming")
+    model = DynamicProgramming(blackjack.Blackjack(blackjack.Table(0, 2)))
+    model.train()
+    result = evaluate(model, blackjack.Table(0, 2), hands=200000, seed=0)
+    assert result.hands >= 200000
+    assert result.ci[0] < model.expected_return < result.ci[1]
+    model.save(tmp_path / "DP.npz")
+    again = evaluate(str(tmp_path / "DP.npz"), blackjack.Table(0, 2), hands=200000, workers=2, seed=0)
+    assert again.mean == result.mean  # whatever the number of workers
+
+    result = evaluate(model, blackjack.Table(6, 3, penetration=0.75), hands=10000, seed=0)
+    assert len(result.seat_means) == 2 and result.hands >= 10000
+
+
+@pytest.mark.parametrize("first_visit", [False, True])
+def test_monte_carlo_evaluator(first_visit):
+    # A trajectory visiting (13, 2, 0) twice, the synthetic way: a blackjack hand never visits a state twice
+    trajectory = [((13, 2, 0), 0), ((15, 2, 0), 0), ((13, 2, 0), 1)]
+    episode = [np.array([[-1.0], [1.0]]), [trajectory, trajectory[1:]]]
+    observations = np.zeros((1, 2, BatchBlackjack.max_decisions, 3), dtype=np.int64)
+    for j, t in enumerate(episode[1]):
+        observations[0, j, :len(t)] = [obs for obs, action in t]
+    evaluator, batch = MonteCarloEvaluator(first_visit, gamma=0.5), MonteCarloEvaluator(first_visit, gamma=0.5)
+    evaluator.observe(*episode)
+    batch.observe_batch(episode[0].reshape(1, 2), observations, np.array([[3, 2]]))
+    assert np.array_equal(evaluator.counts, batch.counts) and np.allclose(evaluator.returns, batch.returns)
+    state = q_state_index((13, 2, 0))
+    assert evaluator.counts[state] == (2 if first_visit else 3)
+    assert evaluator.returns[state] == (-0.25 + 1 if first_visit else -0.25 - 1 + 1)
+    assert evaluator.V[q_obs_index((15, 2, 0))] == pytest.approx((-0.5 + 0.5) / 2)
+
+    game = BatchBlackjack(blackjack.Table(0, 2), batch_size=1000)
+    V = [MonteCarloEvaluator(first_visit).evaluate(game, FixedPolicy(), 5000, nprocs=k, seed=0, task_size=2000).V
+         for k in (1, 2)]
+    assert np.array_equal(V[0], V[1], equal_nan=True)  # whatever the number of workers
+    assert np.nanmax(V[0]) <= 1
+
+
+class Preempted(Exception):
+    pass
+
+
+def preempt(checks):
+    # A criterion interrupting the training, as a preemption would
+    def criterion(monitor):
+        if monitor.checks >= checks:
+            raise Preempted()
+        return False
+    return criterion
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_resume(batch, tmp_path):
+    logger.disable("model.abstract_model")
+
+    def game(seed):
+        if batch:
+            return BatchBlackjack(blackjack.Table(1, 3, rng=seed), batch_size=64)
+        return blackjack.Blackjack(blackjack.Table(6, 3, penetration=0.75, rng=seed), trace=False)
+
+    settings = dict(episodes=3000 if batch else 600, checkpoint_every=128 if batch else 40, stop_at_convergence=False)
+    uninterrupted = SARSA(game(0), rng=1)
+    uninterrupted.train(**settings)
+
+    checkpoint = tmp_path / "checkpoint.npz"
+    interrupted = SARSA(game(0), rng=1)
+    with pytest.raises(Preempted):
+        interrupted.train(checkpoint=checkpoint, criteria=[preempt(20)], **settings)
+    resumed = SARSA(game(5), rng=7)  # the generators are restored from the checkpoint
+    resumed.resume(checkpoint)
+    assert np.array_equal(resumed.Q, uninterrupted.Q)
+    assert resumed.monitor.ewma == uninterrupted.monitor.ewma
+    assert resumed.monitor.checks == uninterrupted.monitor.checks
+
+    resumed.load(checkpoint)  # the last checkpoint is also a saved model
+    assert np.array_equal(resumed.Q, uninterrupted.Q)
+
+    # The run is over: resuming it again only loads the model, and says so
+    logger.enable("model.abstract_model")
+    messages = []
+    sink = logger.add(messages.append, level="WARNING", format="{message}")
+    again = SARSA(game(0), rng=1)
+    again.train(checkpoint=checkpoint, resume=True, **settings)
+    logger.remove(sink)
+    assert np.array_equal(again.Q, uninterrupted.Q)
+    assert len(messages) == 1 and "already over" in messages[0]
+
+    with pytest.raises(ValueError):
+        SARSA(game(0)).train(workers=2, checkpoint=checkpoint, **settings)
+
+
+def test_sweep(tmp_path):
+    import sweep
+    configs = sweep.configurations({"model": ["MC", "QL"], "m": [0], "n": [2], "episodes": [500],
+                                    "learning_rate": [0.01], "gamma": [1.0], "eps_min": [0.05], "seed": [0, 1]})
+    assert len(configs) == 4
+    summary = sweep.sweep(configs, str(tmp_path), workers=2, evaluation_episodes=1000)
+    assert len(summary) == 4 and not summary["cached"].any()
+    assert (summary["episodes_played"] == 500).all()
+    cached = sweep.sweep(configs, str(tmp_path), workers=2, evaluation_episodes=1000)
+    assert cached["cached"].all()
+    assert cached.drop(columns="cached").equals(summary.drop(columns="cached"))
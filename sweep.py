@@ -0,0 +1,147 @@
+"""
+Sweep of training configurations over a process pool.
+
+    python sweep.py                                          # MC, TD and QL on m = 6, 3, 1 and n = 3, 4, 6
+    python sweep.py --models MC --m 0 --n 2 --learning-rate 0.01 0.05 --eps-min 0.05 0.1 --workers 4
+
+Every combination of the values given is a configuration, trained in its own process. Its results are stored under
+a content hash of its parameters (record/sweep/<hash>.npz for the Q-table and <hash>.json for the metrics), so a
+configuration already trained is not trained again, and an interrupted one resumes from its checkpoint. The metrics
+of all the configurations are collected in one table, written to record/sweep/summary.csv.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from functools import partial
+from itertools import product
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from environment import blackjack
+from environment.core import default_rng
+from model.MonteCarloControl import MonteCarloControl
+from model.SARSA import SARSA
+from model.QLearning import QLearning
+from model.evaluation import evaluate
+
+models = {
+    "MC": MonteCarloControl,
+    "TD": SARSA,
+    "QL": QLearning
+}
+# Parameters of a configuration, swept over all the combinations of their values
+parameters = ["model", "m", "n", "episodes", "learning_rate", "gamma", "eps_min", "seed"]
+
+
+def configurations(grid):
+    """
+    :param grid: values of every parameter
+    :type grid: Dict[str, list]
+    :return: every combination of the values
+    :rtype: List[dict]
+    """
+    return [dict(zip(parameters, values)) for values in product(*(grid[name] for name in parameters))]
+
+
+def config_hash(config) -> str:
+    """
+    Content hash of a configuration, independent of the order of its parameters.
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def train(config, directory, evaluation_episodes=100000):
+    """
+    Train one configuration and evaluate the greedy policy learned, unless its results already exist.
+    :param config: the configuration, see parameters.
+    :type config: dict
+    :param directory: where the results are stored.
+    :type directory: str
+    :param evaluation_episodes: hands played by the greedy policy to estimate its expected return, see evaluation.py.
+    :type evaluation_episodes: int
+    :return: the configuration and its metrics
+    :rtype: dict
+    """
+    key = config_hash(dict(config, evaluation_episodes=evaluation_episodes))
+    path = os.path.join(directory, key)
+    if os.path.exists(path + ".json"):
+        with open(path + ".json") as f:
+            return dict(json.load(f), cached=True)
+
+    logger.disable("environment.blackjack")
+    logger.disable("model.abstract_model")
+    rng = default_rng(config["seed"])  # a single seed for the decks and the model
+    game = blackjack.Blackjack(blackjack.Table(config["m"], config["n"], rng=rng), trace=False)
+    model = models[config["model"]](game, rng=rng)
+    checkpoint = path + ".checkpoint.npz"
+    start = time.perf_counter()
+    model.train(episodes=config["episodes"], learning_rate=config["learning_rate"], gamma=config["gamma"],
+                eps_min=config["eps_min"], checkpoint=checkpoint, resume=True)
+    seconds = time.perf_counter() - start  # of the last run only, when resumed
+    with np.load(checkpoint) as loader:
+        episodes = int(loader["episode"])
+    model.save(path + ".npz")
+
+    # Inside a worker of the pool already, the evaluation runs in this process
+    evaluation = evaluate(model, game.table, hands=evaluation_episodes, workers=1, seed=config["seed"])
+    result = dict(config, hash=key, episodes_played=episodes, converged=episodes < config["episodes"],
+                  seconds=seconds, mean_update=model.monitor.mean_update, ewma=model.monitor.ewma,
+                  unseen_pairs=len(model.monitor.visited) - model.monitor.n_visited,
+                  policy_changes=model.monitor.policy_changes, mean_reward=float(evaluation.mean),
+                  ci_low=float(evaluation.ci[0]), ci_high=float(evaluation.ci[1]))
+    # The metrics are written last, their file marks the configuration as done
+    with open(path + ".json.tmp", "w") as f:
+        json.dump(result, f, indent=2)
+    os.replace(path + ".json.tmp", path + ".json")
+    os.remove(checkpoint)
+    return dict(result, cached=False)
+
+
+def sweep(configs, directory, workers=0, evaluation_episodes=100000) -> pd.DataFrame:
+    """
+    Train the configurations over a pool of worker processes.
+    :param workers: number of worker processes, 0 for all the cores.
+    :type workers: int
+    :return: the summary table, one row per configuration.
+    :rtype: pandas.DataFrame
+    """
+    os.makedirs(directory, exist_ok=True)
+    workers = min(workers or multiprocessing.cpu_count(), len(configs))
+    results = []
+    with multiprocessing.Pool(max(workers, 1)) as pool:
+        for result in pool.imap_unordered(partial(train, directory=directory,
+                                                  evaluation_episodes=evaluation_episodes), configs):
+            results.append(result)
+            logger.info("{}/{} {} {}".format(len(results), len(configs), result["hash"],
+                                             "cached" if result["cached"] else "trained"))
+    summary = pd.DataFrame(results, columns=list(results[0]) if results else parameters)
+    return summary.sort_values(parameters, kind="stable").reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep of training configurations over a process pool.")
+    parser.add_argument("--models", nargs="+", default=list(models), choices=list(models))
+    parser.add_argument("--m", nargs="+", type=int, default=[6, 3, 1], help="decks of cards, 0 for infinite")
+    parser.add_argument("--n", nargs="+", type=int, default=[3, 4, 6], help="players, including the dealer")
+    parser.add_argument("--episodes", nargs="+", type=int, default=[500000])
+    parser.add_argument("--learning-rate", nargs="+", type=float, default=[0.01])
+    parser.add_argument("--gamma", nargs="+", type=float, default=[1.0])
+    parser.add_argument("--eps-min", nargs="+", type=float, default=[0.05],
+                        help="epsilon of the k-th episode is min(1/k, eps_min)")
+    parser.add_argument("--seed", nargs="+", type=int, default=[0])
+    parser.add_argument("--workers", type=int, default=0, help="worker processes, 0 for all the cores")
+    parser.add_argument("--evaluation-episodes", type=int, default=100000,
+                        help="hands played by the greedy policy learned")
+    parser.add_argument("-o", "--output", default="./record/sweep", help="directory of the results")
+    args = parser.parse_args()
+
+    grid = {"model": args.models, "m": args.m, "n": args.n, "episodes": args.episodes,
+            "learning_rate": args.learning_rate, "gamma": args.gamma, "eps_min": args.eps_min, "seed": args.seed}
+    summary = sweep(configurations(grid), args.output, args.workers, args.evaluation_episodes)
+    summary.to_csv(os.path.join(args.output, "summary.csv"), index=False)
+    print(summary.to_string(index=False))